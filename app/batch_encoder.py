@@ -0,0 +1,96 @@
+"""
+File: batch_encoder.py
+Author: Dmitry Ryumin and Alexandr Axyonov
+Description: Dynamic micro-batching of concurrent text encodes.
+License: MIT License
+"""
+
+import queue
+import threading
+import time
+from collections.abc import Callable, Sequence
+from concurrent.futures import Future
+from typing import Any, Optional
+
+
+class BatchEncoder:
+    def __init__(
+        self,
+        encode_fn: Callable[[list[str]], Sequence[Any]],
+        max_batch: int = 16,
+        max_wait: float = 0.01,
+    ):
+        self.encode_fn = encode_fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def encode(self, text: str) -> Any:
+        if self.max_batch <= 1 or self.max_wait <= 0:
+            return self.encode_fn([text])[0]
+
+        self._start()
+
+        future = Future()
+        self._queue.put((text, future))
+
+        return future.result()
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._thread is not None:
+                self._queue.put(None)
+                self._thread = None
+
+    def _collect(self) -> Optional[list[tuple[str, Future]]]:
+        item = self._queue.get()
+
+        if item is None:
+            return None
+
+        batch = [item]
+        deadline = time.monotonic() + self.max_wait
+
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+
+            if timeout <= 0:
+                break
+
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+
+            if item is None:
+                self._queue.put(None)
+                break
+
+            batch.append(item)
+
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+
+            if batch is None:
+                return None
+
+            try:
+                results = self.encode_fn([text for text, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
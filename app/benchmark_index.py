@@ -0,0 +1,165 @@
+"""
+File: benchmark_index.py
+Author: Dmitry Ryumin and Alexandr Axyonov
+Description: Recall and latency of the coarse retrieval tiers and the IVF index
+             against exact search.
+License: MIT License
+"""
+
+import argparse
+import time
+import torch
+import polars as pl
+
+# Importing necessary components for the Gradio app
+from app.config import config_data
+from app.data_utils import mmap_tensors, model_cache_path
+from app.embeddings_index import EmbeddingIndex, IVFEmbeddingIndex
+
+TIERS = [
+    ("int8", "none"),
+    ("binary", "none"),
+    ("none", "truncate"),
+    ("none", "pca"),
+]
+
+
+def load_corpus(
+    model_name: str, type_recommendation: int, rows: int, dims: int
+) -> tuple[torch.Tensor, list[str]]:
+    embeddings_path, names_path = [
+        (config_data.StaticPaths_PUDS_EMBEDDINGS, config_data.StaticPaths_RU_SUBJECTS),
+        (
+            config_data.StaticPaths_VACANCIES_EMBEDDINGS,
+            config_data.StaticPaths_RU_VACANCIES,
+        ),
+    ][type_recommendation]
+
+    embeddings_path = model_cache_path(embeddings_path, model_name)
+    names_path = model_cache_path(names_path, model_name)
+
+    if embeddings_path.is_file() and names_path.is_file():
+        embeddings = mmap_tensors(embeddings_path)[0]["embeddings"]
+        names = pl.read_parquet(names_path)["names"].to_list()
+
+        return embeddings, names
+
+    print(f"No cache for {model_name}, using {rows} random vectors of size {dims}")
+
+    generator = torch.Generator().manual_seed(0)
+
+    # Low-rank structure keeps the synthetic spectrum closer to real embeddings
+    embeddings = torch.randn(rows, 64, generator=generator) @ torch.randn(
+        64, dims, generator=generator
+    ) + 0.1 * torch.randn(rows, dims, generator=generator)
+
+    return (
+        torch.nn.functional.normalize(embeddings, dim=1),
+        [str(row) for row in range(rows)],
+    )
+
+
+def measure(
+    index: EmbeddingIndex, queries: torch.Tensor, top_k: int
+) -> tuple[list[set[str]], float]:
+    results = []
+    start = time.perf_counter()
+
+    for query in queries:
+        results.append({name for name, _, _ in index.search(query, top_k)})
+
+    return results, (time.perf_counter() - start) * 1000 / len(queries)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Recall and latency of the coarse retrieval tiers against exact search"
+    )
+    parser.add_argument("--model", default=config_data.Models_SBERT[0])
+    parser.add_argument("--type", type=int, choices=[0, 1], default=0)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=config_data.Settings_TOP_ITEMS)
+    parser.add_argument("--dims", type=int, nargs="+", default=[64, 128, 256])
+    parser.add_argument(
+        "--rerank", type=int, default=config_data.Models_QUANTIZATION_RERANK
+    )
+    parser.add_argument("--probes", type=int, nargs="+", default=[4, 8, 16, 32, 64])
+    parser.add_argument("--lists", type=int, default=config_data.Models_INDEX_IVF_LISTS)
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--size", type=int, default=1024)
+    args = parser.parse_args()
+
+    embeddings, names = load_corpus(args.model, args.type, args.rows, args.size)
+
+    generator = torch.Generator().manual_seed(1)
+    queries = embeddings[
+        torch.randperm(embeddings.size(0), generator=generator)[: args.queries]
+    ].float()
+    queries = torch.nn.functional.normalize(
+        queries + 0.05 * torch.randn(queries.shape, generator=generator), dim=1
+    )
+
+    exact = EmbeddingIndex(embeddings, names, normalized=True)
+    expected, exact_latency = measure(exact, queries, args.top_k)
+
+    print(
+        f"{'tier':<16}{'dims':>6}{f'recall@{args.top_k}':>12}"
+        f"{'ms/query':>10}{'coarse MB':>11}"
+    )
+    print(
+        f"{'exact':<16}{embeddings.size(1):>6}{1:>12.4f}{exact_latency:>10.2f}"
+        f"{embeddings.numel() * embeddings.element_size() / 2**20:>11.1f}"
+    )
+
+    for quantization, reduction in TIERS:
+        for dims in args.dims if reduction != "none" else [embeddings.size(1)]:
+            index = EmbeddingIndex(
+                embeddings,
+                names,
+                quantization=quantization,
+                rerank=args.rerank,
+                normalized=True,
+                reduction=reduction,
+                reduced_dims=dims,
+            )
+            found, latency = measure(index, queries, args.top_k)
+
+            recall = sum(
+                len(found_items & expected_items) / max(len(expected_items), 1)
+                for found_items, expected_items in zip(found, expected)
+            ) / len(expected)
+
+            codes = index.codes.codes
+
+            print(
+                f"{quantization if reduction == 'none' else reduction:<16}{dims:>6}"
+                f"{recall:>12.4f}{latency:>10.2f}"
+                f"{codes.numel() * codes.element_size() / 2**20:>11.1f}"
+            )
+
+    index = IVFEmbeddingIndex(
+        embeddings,
+        names,
+        normalized=True,
+        n_lists=args.lists,
+        iterations=config_data.Models_INDEX_IVF_ITERATIONS,
+    )
+
+    for probes in args.probes:
+        index.probes = probes
+        found, latency = measure(index, queries, args.top_k)
+
+        recall = sum(
+            len(found_items & expected_items) / max(len(expected_items), 1)
+            for found_items, expected_items in zip(found, expected)
+        ) / len(expected)
+
+        print(
+            f"{f'ivf {probes}/{index.n_lists}':<16}{embeddings.size(1):>6}"
+            f"{recall:>12.4f}{latency:>10.2f}"
+            f"{index.centroids.numel() * index.centroids.element_size() / 2**20:>11.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
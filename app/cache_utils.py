@@ -0,0 +1,91 @@
+"""
+File: cache_utils.py
+Author: Dmitry Ryumin and Alexandr Axyonov
+Description: Bounded in-memory caches.
+License: MIT License
+"""
+
+import sys
+import threading
+import time
+import torch
+from collections import OrderedDict
+from collections.abc import Hashable
+from typing import Any, Optional
+
+
+def size_of(value: Any) -> int:
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+
+    return sys.getsizeof(value)
+
+
+class LRUCache:
+    def __init__(
+        self,
+        max_items: int,
+        max_bytes: Optional[int] = None,
+        ttl: Optional[float] = None,
+    ):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._bytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._items
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            if key in self._items and self._items[key][2] < time.monotonic():
+                self._bytes -= self._items.pop(key)[1]
+
+            if key not in self._items:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            self._items.move_to_end(key)
+
+            return self._items[key][0]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        if self.max_items <= 0:
+            return None
+
+        size = size_of(value)
+        expires = time.monotonic() + self.ttl if self.ttl else float("inf")
+
+        with self._lock:
+            if key in self._items:
+                self._bytes -= self._items.pop(key)[1]
+
+            self._items[key] = (value, size, expires)
+            self._bytes += size
+
+            while self._items and (
+                len(self._items) > self.max_items
+                or (self.max_bytes is not None and self._bytes > self.max_bytes)
+            ):
+                self._bytes -= self._items.popitem(last=False)[1][1]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "items": len(self._items),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,81 @@
+"""
+File: cpu_backend.py
+Author: Dmitry Ryumin and Alexandr Axyonov
+Description: Optimized CPU inference backends for the encoders.
+License: MIT License
+"""
+
+import warnings
+import torch
+import torch.nn.functional as F
+from collections.abc import Callable
+from typing import Any
+
+# Importing necessary components for the Gradio app
+from app.config import config_data
+
+BACKENDS = ("torch", "quantized", "onnx")
+
+
+def model_backend(model_name: str) -> str:
+    backends = dict(
+        zip(config_data.Models_SBERT, config_data.Models_BACKEND_SBERT)
+    ) | dict(
+        zip(config_data.Models_SBERT_VACANCY, config_data.Models_BACKEND_SBERT_VACANCY)
+    )
+
+    backend = backends.get(model_name, "torch")
+
+    if backend not in BACKENDS:
+        warnings.warn(f"Unknown backend '{backend}' for {model_name}, using torch")
+        return "torch"
+
+    return backend
+
+
+def quantize_dynamic(model: torch.nn.Module) -> torch.nn.Module:
+    return torch.ao.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=torch.qint8, inplace=False
+    )
+
+
+def parity_cosine(
+    reference: Any,
+    candidate: Any,
+    encode_fn: Callable[[Any, list[str]], torch.Tensor],
+) -> float:
+    texts = config_data.Models_BACKEND_PARITY_TEXTS
+
+    with torch.no_grad():
+        return (
+            F.cosine_similarity(
+                encode_fn(reference, texts).float().cpu(),
+                encode_fn(candidate, texts).float().cpu(),
+                dim=1,
+            )
+            .min()
+            .item()
+        )
+
+
+def select_backend(
+    model_name: str,
+    reference: Any,
+    load_candidate: Callable[[], Any],
+    encode_fn: Callable[[Any, list[str]], torch.Tensor],
+) -> Any:
+    try:
+        candidate = load_candidate()
+        cosine = parity_cosine(reference, candidate, encode_fn)
+    except Exception as e:
+        warnings.warn(f"{model_name}: optimized backend unavailable ({e}), using torch")
+        return reference
+
+    if cosine < config_data.Models_BACKEND_PARITY_MIN_COSINE:
+        warnings.warn(
+            f"{model_name}: optimized backend failed the parity check "
+            f"(min cosine {cosine:.4f}), using torch"
+        )
+        return reference
+
+    return candidate
@@ -5,37 +5,161 @@ Description: Initial data loading.
 License: MIT License
 """
 
-import torch
+import threading
+import time
+import warnings
+import polars as pl
+from dataclasses import dataclass
+from typing import Optional
 
 # Importing necessary components for the Gradio app
 from app.config import config_data
-from app.data_utils import load_parquet
+from app.data_utils import load_parquet, files_version
+from app.cache_utils import LRUCache
 from app.load_models import SbertModelManager
 from app.load_vacancy_models import SkillsExtractor
 
 
-cosine_similarity = torch.nn.CosineSimilarity()
+DATA_PATHS = [
+    config_data.Path_APP / config_data.StaticPaths_PUDS,
+    config_data.Path_APP / config_data.StaticPaths_VACANCIES,
+    config_data.Path_APP / config_data.StaticPaths_PUDS_SKILLS,
+    config_data.Path_APP / config_data.StaticPaths_COURSES_GRADES,
+    config_data.Path_APP / config_data.StaticPaths_VACANCY,
+]
 
-df_puds_skills = load_parquet(
-    path=config_data.Path_APP / config_data.StaticPaths_PUDS_SKILLS,
-    drop_duplicates=True,
-    subset=config_data.DataframeHeaders_RU_ID,
-    drop_columns=None,
+response_cache = LRUCache(
+    max_items=config_data.Settings_RESPONSE_CACHE_SIZE,
+    ttl=config_data.Settings_RESPONSE_CACHE_TTL,
 )
 
-df_courses_grades = load_parquet(
-    path=config_data.Path_APP / config_data.StaticPaths_COURSES_GRADES,
-    drop_duplicates=True,
-    subset=None,
-    drop_columns=None,
-)
 
-model_manager_sbert = SbertModelManager()
-model_manager_sbert.change_model(
-    config_data.Models_SBERT[0],
-    type_embeddings=config_data.Settings_TYPE_RECOMMENDATION[0],
-)
+@dataclass(frozen=True)
+class DataSnapshot:
+    version: str
+    df_puds_skills: pl.DataFrame
+    df_courses_grades: pl.DataFrame
+    model_manager_sbert: SbertModelManager
+    skills_extractor: SkillsExtractor
 
-skills_extractor = SkillsExtractor(
-    path_to_vacancies_info=config_data.Path_APP / config_data.StaticPaths_VACANCY
-)
+
+def warm_up_keys() -> list[tuple[str, str]]:
+    if not config_data.Models_WARMUP_ENABLED:
+        return []
+
+    return [
+        (config_data.Models_SBERT[0], type_recommendation)
+        for type_recommendation in config_data.Settings_TYPE_RECOMMENDATION
+    ] + [
+        (model_name, config_data.Settings_TYPE_RECOMMENDATION[0])
+        for model_name in config_data.Models_SBERT[1:]
+        if config_data.Models_WARMUP_ALL_MODELS
+    ]
+
+
+def load_snapshot(previous: Optional[DataSnapshot] = None) -> DataSnapshot:
+    version = files_version(DATA_PATHS)
+
+    df_puds_skills = load_parquet(
+        path=config_data.Path_APP / config_data.StaticPaths_PUDS_SKILLS,
+        drop_duplicates=True,
+        subset=config_data.DataframeHeaders_RU_ID,
+        drop_columns=None,
+    )
+
+    df_courses_grades = load_parquet(
+        path=config_data.Path_APP / config_data.StaticPaths_COURSES_GRADES,
+        drop_duplicates=True,
+        subset=None,
+        drop_columns=None,
+    )
+
+    model_manager_sbert = SbertModelManager()
+
+    if previous is not None:
+        model_manager_sbert.share_models(previous.model_manager_sbert)
+
+    model_manager_sbert.get_state(
+        config_data.Models_SBERT[0],
+        config_data.Settings_TYPE_RECOMMENDATION[0],
+    )
+
+    if previous is None:
+        model_manager_sbert.warm_up(warm_up_keys())
+    else:
+        # The reload already runs in the background, so the new indexes are ready before the swap
+        for key in warm_up_keys():
+            model_manager_sbert.get_state(*key)
+
+    skills_extractor = SkillsExtractor(
+        path_to_vacancies_info=config_data.Path_APP / config_data.StaticPaths_VACANCY,
+        model=previous.skills_extractor.model if previous is not None else None,
+        tokenizer=previous.skills_extractor.tokenizer if previous is not None else None,
+    )
+
+    return DataSnapshot(
+        version=version,
+        df_puds_skills=df_puds_skills,
+        df_courses_grades=df_courses_grades,
+        model_manager_sbert=model_manager_sbert,
+        skills_extractor=skills_extractor,
+    )
+
+
+snapshot = load_snapshot()
+reload_lock = threading.Lock()
+
+
+def data_snapshot() -> DataSnapshot:
+    return snapshot
+
+
+def reload_data(force: bool = False) -> bool:
+    global snapshot
+
+    if not reload_lock.acquire(blocking=False):
+        return False
+
+    try:
+        if not force and files_version(DATA_PATHS) == snapshot.version:
+            return False
+
+        previous = snapshot
+        # Requests that already hold the previous snapshot finish on it
+        snapshot = load_snapshot(previous)
+
+        previous.skills_extractor.close()
+    finally:
+        reload_lock.release()
+
+    return True
+
+
+def watch_data(interval: float) -> None:
+    seen = snapshot.version
+    failed = None
+
+    while True:
+        time.sleep(interval)
+
+        version = files_version(DATA_PATHS)
+
+        # Reload only once the files have stopped changing for a whole interval
+        if version == seen and version not in (snapshot.version, failed):
+            try:
+                reload_data()
+            except Exception as e:
+                # A broken version is not retried until the files change again
+                failed = version
+                warnings.warn(f"Data reload failed: {e}")
+
+        seen = version
+
+
+if config_data.Reload_WATCH_INTERVAL > 0 and not config_data.AppSettings_DEV:
+    threading.Thread(
+        target=watch_data,
+        args=(config_data.Reload_WATCH_INTERVAL,),
+        name="data-watcher",
+        daemon=True,
+    ).start()
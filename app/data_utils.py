@@ -6,20 +6,53 @@ License: MIT License
 """
 
 import re
+import os
+import json
+import mmap
+import threading
+import warnings
 import torch
+import torch.nn.functional as F
 import polars as pl
 import hashlib
+import shutil
+import tempfile
 from decimal import Decimal, ROUND_HALF_UP
 from pathlib import Path, PosixPath
 from datetime import datetime
 from typing import Any, Union, Optional
+from collections.abc import Callable
+from functools import partial
 
 from sentence_transformers import SentenceTransformer
-from safetensors.torch import save_file, load_file
+from safetensors.torch import save_file
 
 # Importing necessary components for the Gradio app
 from app.gpu_init import device
+from app.multiprocessing_init import num_cores_cpu
 from app.config import config_data
+from app.embeddings_index import EmbeddingIndex, IVFEmbeddingIndex
+from app.cache_utils import LRUCache
+from app.batch_encoder import BatchEncoder
+from app.cpu_backend import model_backend, quantize_dynamic, select_backend
+
+SAFETENSORS_DTYPES = {
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "F32": torch.float32,
+    "I64": torch.int64,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+}
+
+query_embeddings_cache = LRUCache(
+    max_items=config_data.Models_QUERY_CACHE_SIZE,
+    max_bytes=config_data.Models_QUERY_CACHE_MEMORY_MB * 1024**2,
+)
+
+query_encoders = {}
+encoding_worker_model = None
+query_encoders_lock = threading.Lock()
 
 
 def get_files(directory: Union[str, Path], ext: str = "parquet") -> list[Path]:
@@ -165,7 +198,111 @@ def load_vacancies_data(
     return df, df_grouped
 
 
-def get_embeddings(text: str, sbert_model: SentenceTransformer) -> torch.Tensor:
+def index_records(records: list[dict], key: str) -> dict[Any, list[dict]]:
+    index = {}
+
+    for record in records:
+        value = record.get(key)
+
+        if value is not None:
+            index.setdefault(value, []).append(record)
+
+    return index
+
+
+def embedding_records(
+    d_cleaned: list[dict], info_col: str, name_col: str
+) -> list[dict]:
+    return [
+        item
+        for item in d_cleaned
+        if item.get(info_col) and item.get(name_col) is not None
+    ]
+
+
+def load_sentence_transformer(
+    model_name: str, model_device: Union[str, torch.device] = device
+) -> SentenceTransformer:
+    model_path = config_data.Path_APP / config_data.StaticPaths_MODELS / model_name
+
+    model = SentenceTransformer(
+        model_name_or_path=str(model_path),
+        device=model_device,
+        local_files_only=False,
+        trust_remote_code=True,
+    )
+
+    backend = model_backend(model_name)
+
+    if backend == "torch" or torch.device(model_device).type != "cpu":
+        return model
+
+    def load_onnx() -> SentenceTransformer:
+        exported = not (model_path / "onnx" / "model.onnx").is_file()
+
+        onnx_model = SentenceTransformer(
+            model_name_or_path=str(model_path),
+            device=model_device,
+            local_files_only=False,
+            trust_remote_code=True,
+            backend="onnx",
+        )
+
+        if exported:
+            # Optimum also rewrites config.json, so only the onnx/ files are kept
+            export_path = Path(tempfile.mkdtemp(dir=model_path.parent))
+
+            try:
+                onnx_model[0].auto_model.save_pretrained(export_path)
+                (model_path / "onnx").mkdir(exist_ok=True)
+
+                for path in (export_path / "onnx").iterdir():
+                    os.replace(path, model_path / "onnx" / path.name)
+            finally:
+                shutil.rmtree(export_path, ignore_errors=True)
+
+        return onnx_model
+
+    return select_backend(
+        model_name,
+        model,
+        load_onnx if backend == "onnx" else lambda: quantize_dynamic(model),
+        lambda sbert_model, texts: get_embeddings(texts, sbert_model),
+    )
+
+
+def tensor_bytes(value: Any) -> int:
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+
+    # Dynamically quantized Linear layers keep (weight, bias) packed in a tuple
+    if isinstance(value, (tuple, list)):
+        return sum(tensor_bytes(item) for item in value)
+
+    return 0
+
+
+def model_footprint(sbert_model: SentenceTransformer, model_name: str) -> int:
+    footprint = sum(tensor_bytes(value) for value in sbert_model.state_dict().values())
+
+    onnx_path = (
+        config_data.Path_APP
+        / config_data.StaticPaths_MODELS
+        / model_name
+        / "onnx"
+        / "model.onnx"
+    )
+
+    # ONNX Runtime sessions keep their weights outside of torch
+    if model_backend(model_name) == "onnx" and onnx_path.is_file():
+        footprint = max(footprint, onnx_path.stat().st_size)
+
+    return footprint
+
+
+def get_embeddings(
+    text: Union[str, list[str]], sbert_model: SentenceTransformer
+) -> torch.Tensor:
     with torch.no_grad():
         embeddings = sbert_model.encode(
             text,
@@ -177,6 +314,387 @@ def get_embeddings(text: str, sbert_model: SentenceTransformer) -> torch.Tensor:
     return embeddings
 
 
+def text_lengths(texts: list[str], sbert_model: SentenceTransformer) -> list[int]:
+    tokenizer = getattr(sbert_model, "tokenizer", None)
+
+    if tokenizer is None:
+        return [len(text) for text in texts]
+
+    return [
+        len(ids)
+        for ids in tokenizer(texts, add_special_tokens=False, truncation=True)[
+            "input_ids"
+        ]
+    ]
+
+
+def encode_corpus(
+    texts: list[str],
+    sbert_model: SentenceTransformer,
+    batch_size: int = 32,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> torch.Tensor:
+    if not texts:
+        return torch.Tensor()
+
+    lengths = text_lengths(texts, sbert_model)
+    order = sorted(range(len(texts)), key=lambda i: lengths[i], reverse=True)
+
+    embeddings = None
+
+    for start in range(0, len(order), batch_size):
+        batch = order[start : start + batch_size]
+        batch_embeddings = get_embeddings([texts[i] for i in batch], sbert_model)
+
+        if embeddings is None:
+            embeddings = batch_embeddings.new_empty(
+                (len(texts), batch_embeddings.size(1))
+            )
+
+        embeddings[torch.tensor(batch, device=embeddings.device)] = batch_embeddings
+
+        if progress is not None:
+            progress(min(start + batch_size, len(texts)), len(texts))
+
+    return embeddings
+
+
+def init_encoding_worker(model_name: str, threads: int) -> None:
+    global encoding_worker_model
+
+    torch.set_num_threads(threads)
+    encoding_worker_model = load_sentence_transformer(model_name, "cpu")
+
+
+def encode_chunk(
+    chunk: tuple[int, list[str]], batch_size: int
+) -> tuple[int, torch.Tensor]:
+    start, texts = chunk
+
+    return start, encode_corpus(texts, encoding_worker_model, batch_size).cpu()
+
+
+def encode_corpus_parallel(
+    texts: list[str],
+    sbert_model: SentenceTransformer,
+    model_name: str,
+    workers: int,
+    batch_size: int = 32,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> torch.Tensor:
+    if not texts:
+        return torch.Tensor()
+
+    lengths = text_lengths(texts, sbert_model)
+    order = sorted(range(len(texts)), key=lambda i: lengths[i], reverse=True)
+
+    chunk_size = batch_size * config_data.Models_ENCODING_CHUNK_BATCHES
+    chunks = [
+        (start, [texts[i] for i in order[start : start + chunk_size]])
+        for start in range(0, len(order), chunk_size)
+    ]
+
+    embeddings = None
+    done = 0
+
+    context = torch.multiprocessing.get_context("spawn")
+
+    with context.Pool(
+        workers,
+        initializer=init_encoding_worker,
+        initargs=(model_name, max(1, num_cores_cpu // workers)),
+    ) as pool:
+        for start, chunk_embeddings in pool.imap_unordered(
+            partial(encode_chunk, batch_size=batch_size), chunks
+        ):
+            if embeddings is None:
+                embeddings = chunk_embeddings.new_empty(
+                    (len(texts), chunk_embeddings.size(1))
+                )
+
+            rows = torch.tensor(order[start : start + chunk_embeddings.size(0)])
+            embeddings[rows] = chunk_embeddings
+
+            done += chunk_embeddings.size(0)
+
+            if progress is not None:
+                progress(done, len(texts))
+
+    return embeddings
+
+
+def normalize_query(text: str) -> str:
+    return " ".join(text.split()).lower().replace("ё", "е")
+
+
+def get_batch_encoder(
+    sbert_model: SentenceTransformer, model_name: str
+) -> BatchEncoder:
+    with query_encoders_lock:
+        model, encoder = query_encoders.get(model_name, (None, None))
+
+        if model is not sbert_model:
+            if encoder is not None:
+                encoder.close()
+
+            encoder = BatchEncoder(
+                encode_fn=lambda texts: get_embeddings(texts, sbert_model),
+                max_batch=config_data.Models_BATCHING_MAX_BATCH,
+                max_wait=config_data.Models_BATCHING_MAX_WAIT_MS / 1000,
+            )
+            query_encoders[model_name] = (sbert_model, encoder)
+
+    return encoder
+
+
+def release_batch_encoder(model_name: str) -> None:
+    with query_encoders_lock:
+        _, encoder = query_encoders.pop(model_name, (None, None))
+
+    if encoder is not None:
+        encoder.close()
+
+
+def get_query_embeddings(
+    text: str, sbert_model: SentenceTransformer, model_name: str
+) -> torch.Tensor:
+    text = normalize_query(text)
+    key = (model_name, config_data.Models_TASK, text)
+
+    embeddings = query_embeddings_cache.get(key)
+
+    if embeddings is None:
+        # A row of the batch result would keep the whole batch alive in the cache
+        embeddings = get_batch_encoder(sbert_model, model_name).encode(text).clone()
+        query_embeddings_cache.put(key, embeddings)
+
+    return embeddings
+
+
+def save_tensors(
+    tensors: dict[str, torch.Tensor], path: Path, metadata: Optional[dict] = None
+) -> None:
+    tmp_path = path.with_name(f"{path.name}.tmp")
+
+    save_file(tensors, tmp_path, metadata=metadata)
+    os.replace(tmp_path, path)
+
+
+def save_parquet(df: pl.DataFrame, path: Path) -> None:
+    tmp_path = path.with_name(f"{path.name}.tmp")
+
+    df.write_parquet(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def keys_tensor(keys: list[str]) -> torch.Tensor:
+    return torch.tensor([list(bytes.fromhex(key)) for key in keys], dtype=torch.uint8)
+
+
+def tensor_keys(tensor: torch.Tensor) -> list[str]:
+    return [bytes(row).hex() for row in tensor.tolist()]
+
+
+def mmap_tensors(path: Path) -> tuple[dict[str, torch.Tensor], dict[str, str]]:
+    with open(path, "rb") as f:
+        header_size = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_size))
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    metadata = header.pop("__metadata__", None) or {}
+    tensors = {}
+
+    with warnings.catch_warnings():
+        # The mapping is read-only, tensors are never modified in place
+        warnings.simplefilter("ignore", UserWarning)
+
+        for key, info in header.items():
+            dtype = SAFETENSORS_DTYPES[info["dtype"]]
+            start, end = info["data_offsets"]
+
+            tensors[key] = (
+                torch.frombuffer(
+                    buffer,
+                    dtype=dtype,
+                    count=(end - start) // dtype.itemsize,
+                    offset=8 + header_size + start,
+                ).view(info["shape"])
+                if end > start
+                else torch.empty(info["shape"], dtype=dtype)
+            )
+
+    return tensors, metadata
+
+
+def model_cache_path(path: str, model_name: str, suffix: str = "") -> Path:
+    path = config_data.Path_APP / path
+
+    return path.parent / f"{path.stem}_{model_name}{suffix}{path.suffix}"
+
+
+def content_hash(*values: str) -> str:
+    return hashlib.blake2b("\x00".join(values).encode(), digest_size=16).hexdigest()
+
+
+def model_revision(model_name: str) -> str:
+    model_path = config_data.Path_APP / config_data.StaticPaths_MODELS / model_name
+    revision = hashlib.sha256()
+
+    for path in sorted(model_path.rglob("*")) if model_path.is_dir() else []:
+        # Backend exports written next to the weights do not change the embeddings
+        if not path.is_file() or path.relative_to(model_path).parts[0] in (
+            "onnx",
+            "openvino",
+        ):
+            continue
+
+        revision.update(
+            f"{path.relative_to(model_path)}:{path.stat().st_size};".encode()
+        )
+
+        if path.suffix == ".json":
+            revision.update(path.read_bytes())
+
+    return revision.hexdigest()[:16]
+
+
+def cache_manifest(model_name: str, hashes: list[str]) -> dict[str, Any]:
+    return {
+        "model": model_name,
+        "revision": model_revision(model_name),
+        "task": config_data.Models_TASK,
+        "source": hashlib.sha256("".join(hashes).encode()).hexdigest()[:16],
+        "rows": len(hashes),
+        "dtype": config_data.Models_STORE_DTYPE,
+        "backend": model_backend(model_name),
+    }
+
+
+def read_manifest(path: Path) -> dict[str, Any]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_manifest(path: Path, manifest: dict[str, Any]) -> None:
+    tmp_path = path.with_name(f"{path.name}.tmp")
+
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(
+            {**manifest, "built_at": datetime.now().isoformat(timespec="seconds")},
+            f,
+            ensure_ascii=False,
+            indent=4,
+        )
+
+    os.replace(tmp_path, path)
+
+
+def encode_texts(
+    texts: list[str],
+    sbert_model: SentenceTransformer,
+    model_name: str,
+    progress: Optional[Callable[[int, int], None]] = None,
+    workers: int = 1,
+) -> torch.Tensor:
+    workers = workers or num_cores_cpu
+
+    if workers > 1 and sbert_model.device.type == "cpu" and len(texts) > 1:
+        return encode_corpus_parallel(
+            texts,
+            sbert_model,
+            model_name,
+            min(workers, num_cores_cpu),
+            batch_size=config_data.Models_ENCODING_BATCH_SIZE,
+            progress=progress,
+        )
+
+    return encode_corpus(
+        texts,
+        sbert_model,
+        batch_size=config_data.Models_ENCODING_BATCH_SIZE,
+        progress=progress,
+    )
+
+
+def load_checkpoints(
+    path: Path, metadata: dict[str, str]
+) -> tuple[list[str], list[torch.Tensor]]:
+    keys, embeddings = [], []
+
+    for chunk_path in sorted(path.glob("*.safetensors")) if path.is_dir() else []:
+        tensors, chunk_metadata = mmap_tensors(chunk_path)
+
+        if chunk_metadata != metadata:
+            continue
+
+        keys.extend(tensor_keys(tensors["keys"]))
+        embeddings.append(tensors["embeddings"])
+
+    return keys, embeddings
+
+
+def encode_checkpointed(
+    texts: list[str],
+    keys: list[str],
+    encode_fn: Callable[[list[str], Callable[[int, int], None]], torch.Tensor],
+    path: Path,
+    metadata: dict[str, str],
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> torch.Tensor:
+    chunk_rows = config_data.Models_ENCODING_CHECKPOINT_ROWS
+
+    done_keys, chunks = load_checkpoints(path, metadata)
+    done_rows = {key: row for row, key in enumerate(done_keys)}
+
+    todo = [row for row, key in enumerate(keys) if key not in done_rows]
+    encoded = len(keys) - len(todo)
+
+    step = chunk_rows if chunk_rows > 0 else max(len(todo), 1)
+
+    for start in range(0, len(todo), step):
+        rows = todo[start : start + step]
+
+        embeddings = (
+            encode_fn(
+                [texts[row] for row in rows],
+                lambda done, total, offset=encoded: (
+                    progress(offset + done, len(keys)) if progress else None
+                ),
+            )
+            .float()
+            .cpu()
+            .contiguous()
+        )
+
+        if chunk_rows > 0:
+            path.mkdir(parents=True, exist_ok=True)
+            save_tensors(
+                {
+                    "embeddings": embeddings,
+                    "keys": keys_tensor([keys[row] for row in rows]),
+                },
+                path / f"{len(list(path.glob("*.safetensors"))):06d}.safetensors",
+                metadata,
+            )
+
+        for row in rows:
+            done_rows[keys[row]] = len(done_keys)
+            done_keys.append(keys[row])
+
+        chunks.append(embeddings)
+        encoded += len(rows)
+
+    if not keys:
+        return torch.Tensor()
+
+    return torch.cat([chunk.float() for chunk in chunks]).index_select(
+        0, torch.tensor([done_rows[key] for key in keys], dtype=torch.long)
+    )
+
+
 def extract_embeddings(
     model_name: str,
     d_cleaned: list[dict],
@@ -187,90 +705,269 @@ def extract_embeddings(
     names_path: str,
     limit: Optional[int] = None,
     force_reload: bool = False,
+    progress: Optional[Callable[[int, int], None]] = None,
+    policy: Optional[str] = None,
+    workers: int = 1,
 ) -> tuple[torch.Tensor, pl.DataFrame]:
     embeddings_col = "embeddings"
     names_col = "names"
+    hashes_col = "hashes"
 
-    embeddings_path = config_data.Path_APP / embeddings_path
-    names_path = config_data.Path_APP / names_path
+    embeddings_path = model_cache_path(embeddings_path, model_name)
+    names_path = model_cache_path(names_path, model_name)
 
-    embeddings_path = (
-        embeddings_path.parent
-        / f"{embeddings_path.stem}_{model_name}{embeddings_path.suffix}"
-    )
-
-    names_path = (
-        names_path.parent / f"{names_path.stem}_{model_name}{names_path.suffix}"
-    )
+    store_dtype = getattr(torch, config_data.Models_STORE_DTYPE)
 
-    def load_existing_data() -> tuple[torch.Tensor, pl.DataFrame]:
-        embeddings = load_file(embeddings_path)[embeddings_col]
+    def load_existing_data() -> tuple[torch.Tensor, pl.DataFrame, Optional[list[str]]]:
+        tensors, metadata = mmap_tensors(embeddings_path)
+        embeddings = tensors[embeddings_col]
         names = pl.read_parquet(names_path)
 
-        return embeddings, names
+        # Row hashes live next to the vectors, so the two are always replaced together
+        if hashes_col in tensors:
+            hashes = tensor_keys(tensors[hashes_col])
+        elif (
+            hashes_col in names.columns
+            and names_path.stat().st_mtime >= embeddings_path.stat().st_mtime
+        ):
+            hashes = names[hashes_col].to_list()
+        else:
+            hashes = None
 
-    def save_embeddings(embeddings: torch.Tensor, names: list[str]) -> None:
-        if embeddings.size(0) > 0:
-            save_file({embeddings_col: embeddings}, embeddings_path)
-        if names:
-            pl.DataFrame({names_col: names}).write_parquet(names_path)
+        if metadata.get("normalized") != "true" or embeddings.dtype != store_dtype:
+            save_embeddings(embeddings, hashes)
+            embeddings = mmap_tensors(embeddings_path)[0][embeddings_col]
 
-    def valid_cached_data(embeddings: torch.Tensor, names: pl.DataFrame) -> bool:
-        return embeddings.size(0) == names.shape[0] > 0
+        return embeddings, names, hashes
 
-    if not force_reload and embeddings_path.is_file() and names_path.is_file():
-        embeddings, names = load_existing_data()
+    def save_embeddings(
+        embeddings: torch.Tensor,
+        hashes: Optional[list[str]],
+        names: Optional[pl.DataFrame] = None,
+    ) -> None:
+        if embeddings.size(0) > 0:
+            tensors = {
+                embeddings_col: F.normalize(embeddings.float(), dim=1)
+                .to(store_dtype)
+                .contiguous()
+                .cpu()
+            }
+
+            if hashes:
+                tensors[hashes_col] = keys_tensor(hashes)
+
+            save_tensors(tensors, embeddings_path, metadata={"normalized": "true"})
+        if names is not None and names.shape[0] > 0:
+            save_parquet(names, names_path)
+
+    def valid_cached_data(
+        embeddings: torch.Tensor, cached_hashes: Optional[list[str]]
+    ) -> bool:
+        return (
+            cached_hashes is not None and embeddings.size(0) == len(cached_hashes) > 0
+        )
 
-        if valid_cached_data(embeddings, names):
-            if limit:
-                return embeddings[:limit], names[:limit]
+    def paired_names(names: pl.DataFrame, cached_hashes: list[str]) -> bool:
+        return (
+            hashes_col in names.columns and names[hashes_col].to_list() == cached_hashes
+        )
 
-            return embeddings.to(sbert_model.device), names
+    texts, names, hashes = [], [], []
 
-    def process_item(item: dict) -> tuple[Optional[torch.Tensor], Optional[str]]:
-        info = item.get(info_col)
-        name = item.get(name_col)
+    for item in embedding_records(
+        d_cleaned[:limit] if limit else d_cleaned, info_col, name_col
+    ):
+        texts.append(item[info_col])
+        names.append(item[name_col])
+        hashes.append(content_hash(item[name_col], item[info_col]))
 
-        if info:
-            return get_embeddings(info, sbert_model), name
+    policy = policy or config_data.Models_CACHE_POLICY
 
-        return None, None
+    manifest_path = embeddings_path.with_name(f"{embeddings_path.stem}_manifest.json")
+    manifest = cache_manifest(model_name, hashes)
+    cached_manifest = read_manifest(manifest_path)
 
-    processed_items = [
-        process_item(item) for item in (d_cleaned[:limit] if limit else d_cleaned)
+    changed = [
+        key
+        for key in ("model", "revision", "task", "source", "rows")
+        if cached_manifest.get(key) != manifest[key]
     ]
 
-    embeddings, names = zip(
-        *(
-            (embedding, name)
-            for embedding, name in processed_items
-            if embedding is not None and name is not None
+    cached_exists = embeddings_path.is_file() and names_path.is_file()
+
+    if policy == "refuse" and (force_reload or not cached_exists or changed):
+        raise RuntimeError(
+            f"Embeddings cache {embeddings_path.name} is missing or out of date "
+            f"({", ".join(changed) or "force reload"}) and Models.CACHE.POLICY is "
+            "'refuse', build it offline first"
         )
+
+    cached_embeddings = None
+    cached_rows = {}
+
+    if not force_reload and cached_exists:
+        cached_embeddings, cached_names, cached_hashes = load_existing_data()
+
+        # Caches written before row hashes were stored are rebuilt once
+        if valid_cached_data(cached_embeddings, cached_hashes):
+            # Caches without a manifest are assumed to come from the same model
+            same_model = not cached_manifest or not (
+                {"model", "revision", "task"} & set(changed)
+            )
+
+            if (
+                same_model
+                and cached_hashes == hashes
+                and paired_names(cached_names, cached_hashes)
+            ):
+                if changed:
+                    write_manifest(manifest_path, manifest)
+
+                return cached_embeddings.to(sbert_model.device), cached_names
+
+            if same_model and policy == "incremental":
+                cached_rows = {value: row for row, value in enumerate(cached_hashes)}
+
+    missing_rows = {}
+
+    for row, value in enumerate(hashes):
+        if value not in cached_rows and value not in missing_rows:
+            missing_rows[value] = row
+
+    checkpoint_path = embeddings_path.with_name(f"{embeddings_path.stem}_checkpoint")
+
+    encoded_embeddings = encode_checkpointed(
+        [texts[row] for row in missing_rows.values()],
+        list(missing_rows),
+        lambda chunk, chunk_progress: encode_texts(
+            chunk, sbert_model, model_name, chunk_progress, workers
+        ),
+        checkpoint_path,
+        {key: str(manifest[key]) for key in ("model", "revision", "task")},
+        progress,
+    )
+    encoded_rows = {value: row for row, value in enumerate(missing_rows)}
+
+    if not hashes:
+        embeddings_tensor = torch.Tensor()
+    else:
+        embeddings_tensor = torch.empty(
+            (
+                len(hashes),
+                (
+                    cached_embeddings.size(1)
+                    if cached_rows
+                    else encoded_embeddings.size(1)
+                ),
+            )
+        )
+
+        for source, source_rows in (
+            (cached_embeddings, cached_rows),
+            (encoded_embeddings, encoded_rows),
+        ):
+            pairs = [
+                (row, source_rows[value])
+                for row, value in enumerate(hashes)
+                if value in source_rows
+            ]
+
+            if pairs:
+                rows, positions = map(list, zip(*pairs))
+                embeddings_tensor[rows] = (
+                    source.index_select(
+                        0, torch.tensor(positions, device=source.device)
+                    )
+                    .float()
+                    .cpu()
+                )
+
+    save_embeddings(
+        embeddings_tensor,
+        hashes,
+        pl.DataFrame({names_col: names, hashes_col: hashes}),
     )
 
-    embeddings_tensor = (
-        torch.stack(embeddings).to(sbert_model.device) if embeddings else torch.Tensor()
+    embeddings, names, _ = load_existing_data()
+
+    write_manifest(manifest_path, manifest)
+    shutil.rmtree(checkpoint_path, ignore_errors=True)
+
+    return embeddings.to(sbert_model.device), names
+
+
+def load_embeddings_index(
+    model_name: str,
+    embeddings: torch.Tensor,
+    names: pl.DataFrame,
+    index_type: str,
+    embeddings_path: str,
+    force_reload: bool = False,
+) -> EmbeddingIndex:
+    names = names["names"].to_list() if "names" in names.columns else []
+
+    cache_path = model_cache_path(embeddings_path, model_name)
+    pca_path = model_cache_path(embeddings_path, model_name, "_pca")
+    ivf_path = model_cache_path(embeddings_path, model_name, "_ivf")
+    codes_path = model_cache_path(embeddings_path, model_name, "_codes")
+
+    def load_state(path: Path) -> tuple[dict[str, torch.Tensor], dict[str, str]]:
+        if (
+            not force_reload
+            and path.is_file()
+            and path.stat().st_mtime >= cache_path.stat().st_mtime
+        ):
+            # Mapped read-only, so processes serving the same cache share the pages
+            return mmap_tensors(path)
+
+        return {}, {}
+
+    codes_state, codes_metadata = load_state(codes_path)
+
+    options = dict(
+        quantization=config_data.Models_QUANTIZATION_TYPE,
+        rerank=config_data.Models_QUANTIZATION_RERANK,
+        normalized=True,
+        lexical_weight=config_data.Models_LEXICAL_WEIGHT,
+        lexical_candidates=config_data.Models_LEXICAL_CANDIDATES,
+        lexical_first_stage=config_data.Models_LEXICAL_FIRST_STAGE,
+        reduction=dict(
+            zip(config_data.Models_SBERT, config_data.Models_REDUCTION_TYPE)
+        ).get(model_name, "none"),
+        reduced_dims=config_data.Models_REDUCTION_DIMS,
+        pca_sample=config_data.Models_REDUCTION_PCA_SAMPLE,
+        codes_state=codes_state,
+        codes_kind=codes_metadata.get("kind", ""),
     )
 
-    save_embeddings(embeddings_tensor, list(names))
+    if options["reduction"] == "pca":
+        options.update(load_state(pca_path)[0])
 
-    return embeddings_tensor, pl.DataFrame({names_col: list(names)})
+    if index_type != "ivf" or embeddings.size(0) < config_data.Models_INDEX_MIN_ROWS:
+        index = EmbeddingIndex(embeddings, names, **options)
+    else:
+        index = IVFEmbeddingIndex(
+            embeddings,
+            names,
+            n_lists=config_data.Models_INDEX_IVF_LISTS,
+            probes=config_data.Models_INDEX_IVF_PROBES,
+            iterations=config_data.Models_INDEX_IVF_ITERATIONS,
+            **options,
+            **load_state(ivf_path)[0],
+        )
 
+        if index.trained:
+            save_tensors(index.state_dict(), ivf_path)
 
-def filter_unique_items(
-    sorted_items: list[tuple[str, float]], top_n: int
-) -> list[tuple[str, float]]:
-    unique_items = []
-    seen_items = set()
+    if index.projection_trained:
+        save_tensors(index.reduction_state(), pca_path)
 
-    for item, similarity in sorted_items:
-        if item not in seen_items:
-            seen_items.add(item)
-            unique_items.append((item, similarity))
-        if len(unique_items) >= top_n:
-            break
+    if index.codes_built:
+        save_tensors(
+            index.codes_state_dict(), codes_path, {"kind": index.coarse_kind()}
+        )
 
-    return unique_items
+    return index
 
 
 def extract_numbers(courses_str: str) -> list[int]:
@@ -380,6 +1077,16 @@ def format_grade(value: Union[int, float, Decimal]) -> str:
     )
 
 
+def files_version(paths: list[Path]) -> str:
+    stats = [
+        f"{path}:{path.stat().st_size}:{path.stat().st_mtime_ns}"
+        for path in paths
+        if path.is_file()
+    ]
+
+    return hashlib.sha256(";".join(stats).encode()).hexdigest()[:16]
+
+
 def generate_user_id(length: int = 16) -> str:
     return hashlib.sha256(
         datetime.now().isoformat(timespec="milliseconds").encode()
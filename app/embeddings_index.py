@@ -0,0 +1,622 @@
+"""
+File: embeddings_index.py
+Author: Dmitry Ryumin and Alexandr Axyonov
+Description: Classes for top-k retrieval over embeddings.
+License: MIT License
+"""
+
+import math
+import torch
+import torch.nn.functional as F
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+BLOCK_SIZE = 16384
+
+
+def blocks(rows: int, block_size: int = BLOCK_SIZE):
+    for start in range(0, rows, block_size):
+        yield slice(start, min(start + block_size, rows))
+
+
+def pack_bits(embeddings: torch.Tensor) -> torch.Tensor:
+    bits = (embeddings > 0).to(torch.uint8)
+    # Whole 64-bit words, so the codes can be compared as int64
+    bits = F.pad(bits, (0, (-bits.size(-1)) % 64))
+
+    weights = 2 ** torch.arange(7, -1, -1, dtype=torch.uint8, device=bits.device)
+
+    return (bits.view(*bits.shape[:-1], -1, 8) * weights).sum(dim=-1).to(torch.uint8)
+
+
+def popcount(words: torch.Tensor) -> torch.Tensor:
+    words = words - ((words >> 1) & 0x5555555555555555)
+    words = (words & 0x3333333333333333) + ((words >> 2) & 0x3333333333333333)
+    words = (words + (words >> 4)) & 0x0F0F0F0F0F0F0F0F
+
+    return (words * 0x0101010101010101) >> 56
+
+
+def int8_matmul(codes: torch.Tensor, query_codes: torch.Tensor) -> torch.Tensor:
+    try:
+        return torch._int_mm(codes, query_codes)
+    except (AttributeError, RuntimeError):
+        # Integer products of int8 codes stay exact in float32
+        return codes.float() @ query_codes.float()
+
+
+@dataclass
+class Int8Codes:
+    codes: torch.Tensor
+    scales: torch.Tensor
+
+    @classmethod
+    def build(cls, embeddings: torch.Tensor) -> "Int8Codes":
+        scales = torch.empty(embeddings.size(0), device=embeddings.device)
+        codes = torch.empty(
+            embeddings.shape, dtype=torch.int8, device=embeddings.device
+        )
+
+        for block in blocks(embeddings.size(0)):
+            values = embeddings[block].float()
+            scales[block] = values.abs().amax(dim=1).clamp_min(1e-12) / 127
+            codes[block] = torch.round(values / scales[block].unsqueeze(1)).to(
+                torch.int8
+            )
+
+        return cls(codes, scales)
+
+    def scores(self, query: torch.Tensor, rows: Optional[torch.Tensor]) -> torch.Tensor:
+        codes = self.codes if rows is None else self.codes.index_select(0, rows)
+        scales = self.scales if rows is None else self.scales.index_select(0, rows)
+
+        query_scale = query.abs().amax().clamp_min(1e-12) / 127
+        query_codes = torch.round(query / query_scale).to(torch.int8).unsqueeze(1)
+
+        return (
+            torch.cat(
+                [
+                    int8_matmul(codes[block], query_codes).squeeze(1)
+                    for block in blocks(codes.size(0))
+                ]
+            ).to(query.dtype)
+            * scales
+            * query_scale
+        )
+
+
+@dataclass
+class BinaryCodes:
+    codes: torch.Tensor
+
+    @classmethod
+    def build(cls, embeddings: torch.Tensor) -> "BinaryCodes":
+        return cls(
+            torch.cat(
+                [pack_bits(embeddings[block]) for block in blocks(embeddings.size(0))]
+            )
+        )
+
+    def scores(self, query: torch.Tensor, rows: Optional[torch.Tensor]) -> torch.Tensor:
+        codes = self.codes if rows is None else self.codes.index_select(0, rows)
+        words = codes.view(torch.int64)
+        query_words = pack_bits(query).view(torch.int64)
+
+        return -torch.cat(
+            [
+                popcount(torch.bitwise_xor(words[block], query_words)).sum(dim=1)
+                for block in blocks(words.size(0))
+            ]
+        ).to(query.dtype)
+
+
+QUANTIZATION_CODES = {"int8": Int8Codes, "binary": BinaryCodes}
+
+
+def train_pca(
+    embeddings: torch.Tensor, dims: int, sample_size: int = 50000, seed: int = 0
+) -> torch.Tensor:
+    generator = torch.Generator().manual_seed(seed)
+
+    sample = embeddings[
+        torch.randperm(embeddings.size(0), generator=generator)[:sample_size].to(
+            embeddings.device
+        )
+    ].float()
+
+    # Uncentered components best preserve inner products of normalized vectors
+    _, vectors = torch.linalg.eigh(sample.T @ sample / sample.size(0))
+
+    return vectors[:, -dims:].flip(1).contiguous()
+
+
+@dataclass
+class ReducedCodes:
+    codes: torch.Tensor
+    dims: int
+    projection: Optional[torch.Tensor] = None
+
+    @classmethod
+    def build(
+        cls,
+        embeddings: torch.Tensor,
+        dims: int,
+        projection: Optional[torch.Tensor] = None,
+    ) -> "ReducedCodes":
+        codes = torch.empty(
+            (embeddings.size(0), dims), dtype=torch.float16, device=embeddings.device
+        )
+
+        for block in blocks(embeddings.size(0)):
+            codes[block] = cls.reduce(embeddings[block].float(), dims, projection).to(
+                torch.float16
+            )
+
+        return cls(codes, dims, projection)
+
+    @staticmethod
+    def reduce(
+        embeddings: torch.Tensor, dims: int, projection: Optional[torch.Tensor]
+    ) -> torch.Tensor:
+        if projection is None:
+            return F.normalize(embeddings[..., :dims], dim=-1)
+
+        return embeddings @ projection.to(embeddings.device, embeddings.dtype)
+
+    def scores(self, query: torch.Tensor, rows: Optional[torch.Tensor]) -> torch.Tensor:
+        codes = self.codes if rows is None else self.codes.index_select(0, rows)
+        query = self.reduce(query, self.dims, self.projection)
+
+        return torch.cat(
+            [codes[block].to(query.dtype) @ query for block in blocks(codes.size(0))]
+        )
+
+
+REDUCTIONS = ("truncate", "pca")
+
+
+@dataclass
+class EmbeddingIndex:
+    embeddings: torch.Tensor = field(default_factory=lambda: torch.empty(0))
+    names: list[str] = field(default_factory=list)
+    aggregate: str = "amax"
+    quantization: str = "none"
+    rerank: int = 256
+    group_names: list[str] = field(init=False, default_factory=list)
+    group_rows: list[list[int]] = field(init=False, default_factory=list)
+    row_groups: torch.Tensor = field(
+        init=False, default_factory=lambda: torch.empty(0, dtype=torch.long)
+    )
+    normalized: bool = False
+    lexical_weight: float = 0.0
+    lexical_candidates: int = 0
+    lexical_first_stage: bool = False
+    reduction: str = "none"
+    reduced_dims: int = 256
+    pca_sample: int = 50000
+    projection: torch.Tensor = field(default_factory=lambda: torch.empty(0))
+    codes: Optional[Int8Codes | BinaryCodes | ReducedCodes] = field(
+        init=False, default=None
+    )
+    projection_trained: bool = field(init=False, default=False)
+    codes_state: dict[str, torch.Tensor] = field(default_factory=dict)
+    codes_kind: str = ""
+    codes_built: bool = field(init=False, default=False)
+
+    def __post_init__(self):
+        if self.embeddings.numel() == 0:
+            return None
+
+        if len(self.names) != self.embeddings.size(0):
+            raise ValueError(
+                f"Embeddings ({self.embeddings.size(0)}) and names ({len(self.names)}) "
+                "must have the same number of rows"
+            )
+
+        if not self.normalized:
+            self.embeddings = F.normalize(self.embeddings.float(), dim=1).contiguous()
+            self.normalized = True
+
+        groups = {}
+        row_groups = []
+
+        for row, name in enumerate(self.names):
+            group = groups.setdefault(name, len(groups))
+
+            if group == len(self.group_rows):
+                self.group_names.append(name)
+                self.group_rows.append([])
+
+            self.group_rows[group].append(row)
+            row_groups.append(group)
+
+        self.row_groups = torch.tensor(
+            row_groups, dtype=torch.long, device=self.embeddings.device
+        )
+
+        kind = self.coarse_kind()
+
+        if kind == "none":
+            return None
+
+        projection = self.reduction_projection()
+
+        if self.codes_kind == kind and not self.projection_trained:
+            self.codes = self.load_codes(kind, projection)
+
+        if self.codes is None:
+            with torch.no_grad():
+                if kind in QUANTIZATION_CODES:
+                    self.codes = QUANTIZATION_CODES[kind].build(self.embeddings)
+                else:
+                    self.codes = ReducedCodes.build(
+                        self.embeddings, self.reduced_dims, projection
+                    )
+
+            self.codes_built = True
+
+    def coarse_kind(self) -> str:
+        if self.reduction in REDUCTIONS and self.reduced_dims < self.embeddings.size(1):
+            return f"{self.reduction}{self.reduced_dims}"
+
+        if self.quantization in QUANTIZATION_CODES:
+            return self.quantization
+
+        return "none"
+
+    def load_codes(
+        self, kind: str, projection: Optional[torch.Tensor]
+    ) -> Optional[Int8Codes | BinaryCodes | ReducedCodes]:
+        rows, dims = self.embeddings.shape
+        codes = self.codes_state.get("codes")
+        scales = self.codes_state.get("scales")
+
+        if codes is None or codes.dim() != 2 or codes.size(0) != rows:
+            return None
+
+        codes = codes.to(self.embeddings.device)
+
+        if kind == "int8":
+            if codes.size(1) != dims or scales is None or scales.numel() != rows:
+                return None
+
+            return Int8Codes(codes, scales.to(self.embeddings.device))
+
+        if kind == "binary":
+            return BinaryCodes(codes) if codes.size(1) == -(-dims // 64) * 8 else None
+
+        if codes.size(1) != self.reduced_dims:
+            return None
+
+        return ReducedCodes(codes, self.reduced_dims, projection)
+
+    def codes_state_dict(self) -> dict[str, torch.Tensor]:
+        state = {"codes": self.codes.codes.contiguous().cpu()}
+
+        if isinstance(self.codes, Int8Codes):
+            state["scales"] = self.codes.scales.contiguous().cpu()
+
+        return state
+
+    def reduction_projection(self) -> Optional[torch.Tensor]:
+        if self.reduction != "pca":
+            return None
+
+        if self.projection.shape != (self.embeddings.size(1), self.reduced_dims):
+            self.projection = train_pca(
+                self.embeddings, self.reduced_dims, self.pca_sample
+            )
+            self.projection_trained = True
+
+        self.projection = self.projection.to(self.embeddings.device, torch.float32)
+
+        return self.projection
+
+    def reduction_state(self) -> dict[str, torch.Tensor]:
+        return {"projection": self.projection.contiguous().cpu()}
+
+    def __len__(self) -> int:
+        return self.embeddings.size(0) if self.embeddings.numel() > 0 else 0
+
+    def candidate_rows(self, query: torch.Tensor) -> Optional[torch.Tensor]:
+        return None
+
+    def prescreen_rows(
+        self, query: torch.Tensor, rows: Optional[torch.Tensor], top_k: int
+    ) -> Optional[torch.Tensor]:
+        rerank = max(self.rerank, top_k)
+
+        if (
+            self.codes is None
+            or (len(self) if rows is None else rows.numel()) <= rerank
+        ):
+            return rows
+
+        selected = torch.topk(self.codes.scores(query, rows), rerank).indices
+
+        return selected if rows is None else rows.index_select(0, selected)
+
+    def search(
+        self,
+        query: torch.Tensor,
+        top_k: int,
+        mask: Optional[torch.Tensor] = None,
+        lexical: Optional[torch.Tensor] = None,
+    ) -> list[tuple[str, float, int]]:
+        if len(self) == 0 or top_k <= 0:
+            return []
+
+        top_k = min(int(top_k), len(self.group_names))
+
+        query = F.normalize(
+            query.reshape(-1).to(self.embeddings.device, torch.float32), dim=0
+        )
+
+        with torch.no_grad():
+            allowed = None if mask is None else mask.nonzero().squeeze(1)
+
+            if allowed is not None and allowed.numel() == 0:
+                return []
+
+            if lexical is not None:
+                lexical = lexical.to(self.embeddings.device)
+
+            lexical_rows, lexical_groups = self.lexical_rows(lexical, mask)
+
+            if self.lexical_first_stage and lexical_groups >= top_k:
+                rows = lexical_rows
+            else:
+                rows = self.candidate_rows(query)
+
+                if mask is not None:
+                    rows = allowed if rows is None else rows[mask.index_select(0, rows)]
+
+                rows = self.prescreen_rows(query, rows, top_k)
+
+                if rows is not None and lexical_rows is not None:
+                    rows = torch.unique(torch.cat([rows, lexical_rows]))
+
+            values, groups, best_rows = self.top_groups(query, rows, top_k, lexical)
+
+            if rows is not allowed and torch.isinf(values[-1]):
+                values, groups, best_rows = self.top_groups(
+                    query, allowed, top_k, lexical
+                )
+
+        return [
+            (self.group_names[group], value, row)
+            for group, value, row in zip(
+                groups.tolist(), values.tolist(), best_rows.tolist()
+            )
+            if value != float("-inf")
+        ]
+
+    def lexical_rows(
+        self, lexical: Optional[torch.Tensor], mask: Optional[torch.Tensor]
+    ) -> tuple[Optional[torch.Tensor], int]:
+        if lexical is None or self.lexical_candidates <= 0:
+            return None, 0
+
+        values, groups = torch.topk(
+            lexical, min(self.lexical_candidates, lexical.numel())
+        )
+        groups = groups[values > 0]
+
+        if groups.numel() == 0:
+            return None, 0
+
+        row_mask = torch.isin(self.row_groups, groups)
+
+        if mask is not None:
+            row_mask &= mask
+
+        return row_mask.nonzero().squeeze(1), groups.numel()
+
+    def top_groups(
+        self,
+        query: torch.Tensor,
+        rows: Optional[torch.Tensor],
+        top_k: int,
+        lexical: Optional[torch.Tensor] = None,
+    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        if rows is None:
+            scores = torch.cat(
+                [self.embeddings[block].float() @ query for block in blocks(len(self))]
+            )
+            rows = torch.arange(len(self), device=scores.device)
+            row_groups = self.row_groups
+        else:
+            scores = self.embeddings.index_select(0, rows).float() @ query
+            row_groups = self.row_groups.index_select(0, rows)
+
+        def reduce_groups(reduce: str) -> torch.Tensor:
+            return torch.full(
+                (len(self.group_names),),
+                float("-inf"),
+                dtype=scores.dtype,
+                device=scores.device,
+            ).scatter_reduce_(0, row_groups, scores, reduce=reduce, include_self=False)
+
+        group_scores = reduce_groups(self.aggregate)
+        group_max = group_scores if self.aggregate == "amax" else reduce_groups("amax")
+
+        # Best scoring candidate row of every group, i.e. the record to display
+        best = scores == group_max.index_select(0, row_groups)
+        best_rows = torch.full(
+            (len(self.group_names),), -1, dtype=torch.long, device=scores.device
+        ).scatter_(0, row_groups[best], rows[best])
+
+        if lexical is None or self.lexical_weight <= 0:
+            values, groups = torch.topk(group_scores, top_k)
+        else:
+            _, groups = torch.topk(group_scores + self.lexical_weight * lexical, top_k)
+            values = group_scores.index_select(0, groups)
+
+        return values, groups, best_rows.index_select(0, groups)
+
+
+@dataclass
+class FacetIndex:
+    codes: dict[str, torch.Tensor] = field(default_factory=dict)
+    vocabulary: dict[str, dict[Any, int]] = field(default_factory=dict)
+    size: int = 0
+
+    @classmethod
+    def build(cls, records: list[dict], columns: list[str]) -> "FacetIndex":
+        codes = {}
+        vocabulary = {}
+
+        # One value id per embedding row, so filters combine within a single record
+        for column in columns:
+            values = vocabulary[column] = {}
+            codes[column] = torch.tensor(
+                [
+                    (
+                        values.setdefault(record[column], len(values))
+                        if record.get(column) is not None
+                        else -1
+                    )
+                    for record in records
+                ],
+                dtype=torch.int32,
+            )
+
+        return cls(codes, vocabulary, len(records))
+
+    def values(self, column: str) -> list:
+        return sorted(self.vocabulary.get(column, {}), key=str)
+
+    def row_mask(self, filters: dict[str, list]) -> Optional[torch.Tensor]:
+        mask = None
+
+        for column, values in filters.items():
+            if column not in self.codes or not values:
+                continue
+
+            ids = torch.tensor(
+                [
+                    self.vocabulary[column][value]
+                    for value in values
+                    if value in self.vocabulary[column]
+                ],
+                dtype=torch.int32,
+            )
+            column_mask = torch.isin(self.codes[column], ids)
+
+            mask = column_mask if mask is None else mask & column_mask
+
+        return mask
+
+
+def train_ivf(
+    embeddings: torch.Tensor, n_lists: int, iterations: int = 10, seed: int = 0
+) -> torch.Tensor:
+    generator = torch.Generator().manual_seed(seed)
+
+    sample_size = min(embeddings.size(0), n_lists * 64)
+    sample = embeddings[
+        torch.randperm(embeddings.size(0), generator=generator)[:sample_size].to(
+            embeddings.device
+        )
+    ].float()
+
+    centroids = sample[
+        torch.randperm(sample_size, generator=generator)[:n_lists].to(sample.device)
+    ].clone()
+
+    for _ in range(iterations):
+        assignments = assign_ivf(sample, centroids)
+
+        sums = torch.zeros_like(centroids).index_add_(0, assignments, sample)
+        counts = torch.bincount(assignments, minlength=n_lists)
+
+        empty = counts == 0
+        if empty.any():
+            sums[empty] = sample[
+                torch.randint(sample_size, (int(empty.sum()),), generator=generator).to(
+                    sample.device
+                )
+            ]
+
+        centroids = F.normalize(sums, dim=1)
+
+    return centroids
+
+
+def assign_ivf(embeddings: torch.Tensor, centroids: torch.Tensor) -> torch.Tensor:
+    return torch.cat(
+        [
+            (embeddings[block].float() @ centroids.T).argmax(dim=1)
+            for block in blocks(embeddings.size(0))
+        ]
+    )
+
+
+@dataclass
+class IVFEmbeddingIndex(EmbeddingIndex):
+    n_lists: int = 0
+    probes: int = 8
+    iterations: int = 10
+    centroids: torch.Tensor = field(default_factory=lambda: torch.empty(0))
+    assignments: torch.Tensor = field(
+        default_factory=lambda: torch.empty(0, dtype=torch.long)
+    )
+    list_rows: torch.Tensor = field(
+        init=False, default_factory=lambda: torch.empty(0, dtype=torch.long)
+    )
+    list_offsets: list[int] = field(init=False, default_factory=list)
+    trained: bool = field(init=False, default=False)
+
+    def __post_init__(self):
+        super().__post_init__()
+
+        if len(self) == 0:
+            return None
+
+        if self.n_lists <= 0:
+            self.n_lists = max(1, int(math.sqrt(len(self))))
+
+        self.n_lists = min(self.n_lists, len(self))
+
+        with torch.no_grad():
+            if not self.valid_lists():
+                self.centroids = train_ivf(
+                    self.embeddings, self.n_lists, self.iterations
+                )
+                self.assignments = assign_ivf(self.embeddings, self.centroids)
+                self.trained = True
+
+            self.centroids = self.centroids.to(self.embeddings.device)
+            self.assignments = self.assignments.to(self.embeddings.device)
+
+            self.list_rows = torch.argsort(self.assignments, stable=True)
+            self.list_offsets = [0] + torch.bincount(
+                self.assignments, minlength=self.n_lists
+            ).cumsum(0).tolist()
+
+    def valid_lists(self) -> bool:
+        return (
+            self.centroids.dim() == 2
+            and self.centroids.size(0) == self.n_lists
+            and self.centroids.size(1) == self.embeddings.size(1)
+            and self.assignments.numel() == len(self)
+        )
+
+    def candidate_rows(self, query: torch.Tensor) -> Optional[torch.Tensor]:
+        if self.probes >= self.n_lists:
+            return None
+
+        lists = torch.topk(self.centroids @ query, self.probes).indices.tolist()
+
+        return torch.cat(
+            [
+                self.list_rows[self.list_offsets[i] : self.list_offsets[i + 1]]
+                for i in lists
+            ]
+        )
+
+    def state_dict(self) -> dict[str, torch.Tensor]:
+        return {
+            "centroids": self.centroids.contiguous().cpu(),
+            "assignments": self.assignments.contiguous().cpu(),
+        }
@@ -8,6 +8,7 @@ License: MIT License
 import gradio as gr
 
 # Importing necessary components for the Gradio app
+from app.config import config_data
 from app.event_handlers.account import event_handler_account
 from app.event_handlers.auth import event_handler_auth
 from app.event_handlers.login import event_handler_login
@@ -51,12 +52,15 @@ def setup_app_event_handlers(
     feedback,
     evaluate_column,
     send_evaluate,
+    retrieval_state,
     type_recommendation,
     top_items,
     max_skill_words,
     dropdown_models,
     settings_row_2,
     dropdown_courses_grades,
+    dropdown_facets,
+    index_key,
 ):
     account.click(
         fn=event_handler_account,
@@ -144,6 +148,9 @@ def setup_app_event_handlers(
             top_items,
             max_skill_words,
             dropdown_courses_grades,
+            retrieval_state,
+            index_key,
+            *dropdown_facets,
         ],
         outputs=[
             message_row,
@@ -159,8 +166,10 @@ def setup_app_event_handlers(
             feedback,
             evaluate_column,
             send_evaluate,
+            retrieval_state,
         ],
         queue=True,
+        concurrency_limit=config_data.Models_BATCHING_CONCURRENCY,
     )
 
     chatbot.clear(
@@ -211,6 +220,8 @@ def setup_app_event_handlers(
             dropdown_courses_grades,
             chatbot,
             send_message,
+            index_key,
+            *dropdown_facets,
         ],
         queue=True,
     )
@@ -218,6 +229,6 @@ def setup_app_event_handlers(
     dropdown_models.change(
         fn=event_handler_dropdown_models,
         inputs=[message, type_recommendation, dropdown_models],
-        outputs=[send_message],
+        outputs=[send_message, index_key],
         queue=True,
     )
@@ -7,8 +7,9 @@ License: MIT License
 
 import re
 import random
-import torch
 import polars as pl
+from collections.abc import Iterator
+from typing import Any, Optional
 import gradio as gr
 from gradio import ChatMessage
 from datetime import datetime, timezone
@@ -16,16 +17,9 @@ from datetime import datetime, timezone
 # Importing necessary components for the Gradio app
 from app.config import config_data
 
-from app.data_init import (
-    cosine_similarity,
-    df_puds_skills,
-    df_courses_grades,
-    model_manager_sbert,
-    skills_extractor,
-)
+from app.data_init import DataSnapshot, data_snapshot, response_cache
 from app.data_utils import (
-    get_embeddings,
-    filter_unique_items,
+    get_query_embeddings,
     sort_subjects,
     sort_vacancies,
     round_if_number,
@@ -143,7 +137,9 @@ def generate_item_info(
     )
 
 
-def generate_subject_skills(item_id: str, max_skill_words: int) -> str:
+def generate_subject_skills(
+    item_id: str, max_skill_words: int, df_puds_skills: pl.DataFrame
+) -> str:
     try:
         if not config_data.AppSettings_DEV:
             item_skills = (
@@ -219,136 +215,121 @@ def generate_vacancy_skills(skills: str, max_skill_words: int) -> str:
         )
 
 
-def get_default_ui_response(chat_history: list[ChatMessage]) -> tuple[
-    gr.Row,
-    gr.Textbox,
-    gr.Button,
-    list[ChatMessage],
-    gr.Textbox,
-    gr.Column,
-    gr.Dropdown,
-    gr.Dropdown,
-    gr.HTML,
-    gr.Textbox,
-    gr.Column,
-    gr.Button,
-]:
+def add_courses_grades(
+    item_info: list[str],
+    dropdown_courses_grades: list[str],
+    df_courses_grades: pl.DataFrame,
+) -> list[str]:
+    for grade, mean_grade in zip(
+        config_data.DataframeHeaders_COURSES_GRADES[::2],
+        config_data.DataframeHeaders_COURSES_GRADES[1::2],
+    ):
+        if grade not in dropdown_courses_grades:
+            item_info.extend(["-", "-"])
+            continue
+
+        course_grades = df_courses_grades.filter(
+            pl.col(config_data.DataframeHeaders_RU_ID) == int(item_info[0])
+        )[0]
+
+        curr_grade = round_if_number(course_grades[grade][0])
+        mean_curr_grade = (
+            round_if_number(course_grades[mean_grade][0])
+            if mean_grade in course_grades.columns
+            else "-"
+        )
+
+        item_info.extend([curr_grade, mean_curr_grade])
+
+    return item_info
+
+
+def generate_vacancy_skills_block(vacancy_skills: list[str]) -> str:
+    skills_vacancy = "".join(
+        [f"<span class='skill'>{skill}</span>" for skill in vacancy_skills]
+    )
+
     return (
-        gr.Row(visible=True),
-        gr.Textbox(value=None),
-        gr.Button(visible=True),
-        chat_history,
-        gr.Textbox(value=None, visible=False),
-        gr.Column(visible=False),
-        gr.Dropdown(interactive=False, visible=False),
-        gr.Dropdown(interactive=False, visible=False),
-        gr.HTML(visible=False),
-        gr.Textbox(value=None, visible=False),
-        gr.Column(visible=False),
-        gr.Button(visible=False, interactive=False),
+        f"<div class='subject-info{"-static" if not config_data.AppSettings_QUALITY else ""}'>"
+        "<div class='info'><div class='info-skills'><span class='label'>"
+        + (
+            config_data.HtmlContent_VACANCY_SKILLS_LABEL.format(
+                "<span class='important'>"
+                + config_data.HtmlContent_VACANCY_SKILLS_LABEL_CLICK
+                + "</span>"
+            )
+            if config_data.AppSettings_QUALITY
+            else config_data.HtmlContent_VACANCY_SKILLS_LABEL_STATIC
+        )
+        + "</span> <span class='value'>"
+        + f"{skills_vacancy}</span></div></div></div>"
     )
 
 
-def event_handler_generate_response(
+def generate_response_content(
     message: str,
-    chat_history: list[ChatMessage],
     type_recommendation: str,
     top_items: int,
     max_skill_words: int,
     dropdown_courses_grades: list[str],
-) -> tuple[
-    gr.Row,
-    gr.Textbox,
-    gr.Button,
-    gr.Textbox,
-    list[ChatMessage],
-    gr.Textbox,
-    gr.Column,
-    gr.Dropdown,
-    gr.Dropdown,
-    gr.HTML,
-    gr.Textbox,
-    gr.Column,
-    gr.Button,
-]:
-    message = message.strip()
-
-    if not message:
-        return get_default_ui_response(chat_history)
+    filters: dict[str, list],
+    retrieval: dict[str, Any],
+    model_name: str,
+    snapshot: DataSnapshot,
+) -> Iterator[str]:
+    if type_recommendation == config_data.Settings_TYPE_RECOMMENDATION[0]:
+        if retrieval["vacancy_skills"] is None:
+            retrieval["vacancy_skills"] = (
+                snapshot.skills_extractor.key_skills_for_profession(message)
+                if not config_data.AppSettings_DEV
+                else create_numbered_list(Dev.VACANCY_SKILLS)
+            )
 
-    if config_data.AppSettings_QUALITY:
-        type_recommendation, top_items, max_skill_words, dropdown_courses_grades = (
-            config_data.Settings_TYPE_RECOMMENDATION[0],
-            config_data.Settings_TOP_ITEMS_QUALITY,
-            config_data.Settings_MAX_SKILL_WORDS,
-            config_data.DataframeHeaders_COURSES_GRADES[0:1],
-        )
+        yield generate_vacancy_skills_block(retrieval["vacancy_skills"])
 
     if not config_data.AppSettings_DEV:
-        embedding = get_embeddings(message, model_manager_sbert.get_current_model())
+        if retrieval["items"] is None:
+            state = snapshot.model_manager_sbert.get_state(
+                model_name, type_recommendation
+            )
 
-        with torch.no_grad():
-            similarities = (
-                cosine_similarity(embedding, model_manager_sbert.state.embeddings)
-                .cpu()
-                .tolist()
+            embedding = get_query_embeddings(message, state.current_model, model_name)
+
+            retrieval["items"] = state.search(
+                embedding, config_data.Settings_TOP_ITEMS_RANGE[1], filters, message
             )
-            similarities = [
-                (name, sim)
-                for name, sim in zip(
-                    model_manager_sbert.state.names["names"], similarities
-                )
-            ]
 
-        unique_items = filter_unique_items(
-            sorted(similarities, key=lambda x: x[1], reverse=True), top_items
-        )
+        if not retrieval["items"]:
+            yield (
+                "<div class='info-skills-error'><span class='label'>"
+                + config_data.InformationMessages_ITEMS_NOT_FOUND
+                + "</span></div>"
+            )
+            return None
+
+        unique_items = retrieval["items"][: int(top_items)]
 
         all_top_items = []
 
-        for item, similarity in unique_items:
+        for item, similarity, match in unique_items:
             if type_recommendation == config_data.Settings_TYPE_RECOMMENDATION[0]:
-                match = next(
-                    (
-                        itm
-                        for itm in model_manager_sbert.get_puds_data()
-                        if itm.get(config_data.DataframeHeaders_RU_SUBJECTS[0]) == item
-                    ),
-                    None,
+                formatted_item = (
+                    f"{match.get(config_data.DataframeHeaders_RU_ID, "-")} | {item} | CS={similarity:.4f} | "
+                    f"{match.get(config_data.DataframeHeaders_RU_SUBJECTS[2], "-")} | "
+                    + f"{match.get(config_data.DataframeHeaders_RU_SUBJECTS[1], "-")} | "
+                    f"{match.get(config_data.DataframeHeaders_RU_SUBJECTS[3], "-")} | "
+                    + f"{match.get(config_data.DataframeHeaders_RU_SUBJECTS[4], "-")} | "
+                    f"{match.get(config_data.DataframeHeaders_RU_SUBJECTS[5], "-")} | "
+                    + f"{match.get(config_data.DataframeHeaders_RU_SUBJECTS[6], "-")} | "
+                    + f"{match.get(config_data.DataframeHeaders_RU_SUBJECTS[7], "-")} | "
+                    + f"{match.get(config_data.DataframeHeaders_RU_SUBJECTS[8], "-")}"
                 )
-
-                if match:
-                    formatted_item = (
-                        f"{match.get(config_data.DataframeHeaders_RU_ID, "-")} | {item} | CS={similarity:.4f} | "
-                        f"{match.get(config_data.DataframeHeaders_RU_SUBJECTS[2], "-")} | "
-                        + f"{match.get(config_data.DataframeHeaders_RU_SUBJECTS[1], "-")} | "
-                        f"{match.get(config_data.DataframeHeaders_RU_SUBJECTS[3], "-")} | "
-                        + f"{match.get(config_data.DataframeHeaders_RU_SUBJECTS[4], "-")} | "
-                        f"{match.get(config_data.DataframeHeaders_RU_SUBJECTS[5], "-")} | "
-                        + f"{match.get(config_data.DataframeHeaders_RU_SUBJECTS[6], "-")} | "
-                        + f"{match.get(config_data.DataframeHeaders_RU_SUBJECTS[7], "-")} | "
-                        + f"{match.get(config_data.DataframeHeaders_RU_SUBJECTS[8], "-")}"
-                    )
-                else:
-                    formatted_item = f"- | {item} | CS={similarity:.4f}"
             elif type_recommendation == config_data.Settings_TYPE_RECOMMENDATION[1]:
-                match = next(
-                    (
-                        itm
-                        for itm in model_manager_sbert.get_vacancies_data()
-                        if itm.get(config_data.DataframeHeaders_VACANCIES[1]) == item
-                    ),
-                    None,
+                formatted_item = (
+                    f"{item} | CS={similarity:.4f} | "
+                    f"{match.get(config_data.DataframeHeaders_VACANCIES[3], "-")}"
                 )
 
-                if match:
-                    formatted_item = (
-                        f"{item} | CS={similarity:.4f} | "
-                        f"{match.get(config_data.DataframeHeaders_VACANCIES[3], "-")}"
-                    )
-                else:
-                    formatted_item = f"{item} | CS={similarity:.4f}"
-
             all_top_items.append(formatted_item)
 
         if type_recommendation == config_data.Settings_TYPE_RECOMMENDATION[0]:
@@ -358,27 +339,6 @@ def event_handler_generate_response(
             for item in items_sorted.split(";"):
                 item_info = list(map(str.strip, item.split("|")))
 
-                for grade, mean_grade in zip(
-                    config_data.DataframeHeaders_COURSES_GRADES[::2],
-                    config_data.DataframeHeaders_COURSES_GRADES[1::2],
-                ):
-                    if grade not in dropdown_courses_grades:
-                        item_info.extend(["-", "-"])
-                        continue
-
-                    course_grades = df_courses_grades.filter(
-                        pl.col(config_data.DataframeHeaders_RU_ID) == int(item_info[0])
-                    )[0]
-
-                    curr_grade = round_if_number(course_grades[grade][0])
-                    mean_curr_grade = (
-                        round_if_number(course_grades[mean_grade][0])
-                        if mean_grade in course_grades.columns
-                        else "-"
-                    )
-
-                    item_info.extend([curr_grade, mean_curr_grade])
-
                 edu_level_label, edu_level = determine_edu_level(item_info)
 
                 if edu_level not in grouped_items:
@@ -387,61 +347,42 @@ def event_handler_generate_response(
         elif type_recommendation == config_data.Settings_TYPE_RECOMMENDATION[1]:
             items_sorted = sort_vacancies(all_top_items)
 
-    content = ""
-
     if type_recommendation == config_data.Settings_TYPE_RECOMMENDATION[0]:
-        if not config_data.AppSettings_DEV:
-            vacancy_skills = skills_extractor.key_skills_for_profession(message)
-        else:
-            vacancy_skills = create_numbered_list(Dev.VACANCY_SKILLS)
-
-        skills_vacancy = "".join(
-            [f"<span class='skill'>{skill}</span>" for skill in vacancy_skills]
-        )
-
-        content += (
-            f"<div class='subject-info{"-static" if not config_data.AppSettings_QUALITY else ""}'>"
-            "<div class='info'><div class='info-skills'><span class='label'>"
-            + (
-                config_data.HtmlContent_VACANCY_SKILLS_LABEL.format(
-                    "<span class='important'>"
-                    + config_data.HtmlContent_VACANCY_SKILLS_LABEL_CLICK
-                    + "</span>"
-                )
-                if config_data.AppSettings_QUALITY
-                else config_data.HtmlContent_VACANCY_SKILLS_LABEL_STATIC
-            )
-            + "</span> <span class='value'>"
-            + f"{skills_vacancy}</span></div></div></div>"
-        )
-
         item = 1
 
         if config_data.AppSettings_DEV:
             grouped_items = Dev.GROUPED_ITEMS
 
         for edu_level, items in grouped_items.items():
-            content += f"<div class='edu-group'><span>{edu_level}</span><div class='subject-info'>"
+            if not config_data.AppSettings_DEV:
+                for item_info, _, _ in items:
+                    add_courses_grades(
+                        item_info, dropdown_courses_grades, snapshot.df_courses_grades
+                    )
 
-            content += "".join(
-                "<div class='info'>"
-                f"<div class='item'>{item}</div>"
-                + generate_item_info(item_info, edu_level_label, edu_level)
-                + generate_subject_skills(item_info[0], max_skill_words)
-                + "</div>"
-                for item, (item_info, edu_level_label, edu_level) in enumerate(
-                    items, start=item
+            yield (
+                f"<div class='edu-group'><span>{edu_level}</span><div class='subject-info'>"
+                + "".join(
+                    "<div class='info'>"
+                    f"<div class='item'>{item}</div>"
+                    + generate_item_info(item_info, edu_level_label, edu_level)
+                    + generate_subject_skills(
+                        item_info[0], max_skill_words, snapshot.df_puds_skills
+                    )
+                    + "</div>"
+                    for item, (item_info, edu_level_label, edu_level) in enumerate(
+                        items, start=item
+                    )
                 )
+                + "</div></div>"
             )
 
             item += len(items)
-
-            content += "</div></div>"
     elif type_recommendation == config_data.Settings_TYPE_RECOMMENDATION[1]:
         if config_data.AppSettings_DEV:
             items_sorted = Dev.ITEMS_SORTED
 
-        content += (
+        yield (
             "<div class='vacancy-info-static'>"
             + "".join(
                 "<div class='info'>"
@@ -458,10 +399,184 @@ def event_handler_generate_response(
             + "</div>"
         )
 
-    chat_history.append(ChatMessage(role="user", content=message))
-    chat_history.append(ChatMessage(role="assistant", content=content))
 
+def get_retrieval_state(
+    retrieval_state: Optional[dict[str, Any]], retrieval_key: tuple
+) -> dict[str, Any]:
+    if retrieval_state and retrieval_state.get("key") == retrieval_key:
+        return retrieval_state
+
+    return {"key": retrieval_key, "items": None, "vacancy_skills": None}
+
+
+def get_default_ui_response(chat_history: list[ChatMessage]) -> tuple[
+    gr.Row,
+    gr.Textbox,
+    gr.Button,
+    gr.Textbox,
+    list[ChatMessage],
+    gr.Textbox,
+    gr.Column,
+    gr.Dropdown,
+    gr.Dropdown,
+    gr.HTML,
+    gr.Textbox,
+    gr.Column,
+    gr.Button,
+]:
+    return (
+        gr.Row(visible=True),
+        gr.Textbox(value=None),
+        gr.Button(visible=True),
+        gr.Textbox(visible=False),
+        chat_history,
+        gr.Textbox(value=None, visible=False),
+        gr.Column(visible=False),
+        gr.Dropdown(interactive=False, visible=False),
+        gr.Dropdown(interactive=False, visible=False),
+        gr.HTML(visible=False),
+        gr.Textbox(value=None, visible=False),
+        gr.Column(visible=False),
+        gr.Button(visible=False, interactive=False),
+    )
+
+
+def get_streaming_ui_response(
+    chat_history: list[ChatMessage], send_visible: bool = False
+) -> tuple:
     return (
+        gr.skip(),
+        gr.skip(),
+        gr.Button(visible=send_visible),
+        gr.skip(),
+        chat_history,
+        *(gr.skip() for _ in range(9)),
+    )
+
+
+def event_handler_generate_response(
+    message: str,
+    chat_history: list[ChatMessage],
+    type_recommendation: str,
+    top_items: int,
+    max_skill_words: int,
+    dropdown_courses_grades: list[str],
+    retrieval_state: Optional[dict[str, Any]],
+    index_key: tuple[str, str],
+    *dropdown_facets: list[str],
+) -> Iterator[
+    tuple[
+        gr.Row,
+        gr.Textbox,
+        gr.Button,
+        gr.Textbox,
+        list[ChatMessage],
+        gr.Textbox,
+        gr.Column,
+        gr.Dropdown,
+        gr.Dropdown,
+        gr.HTML,
+        gr.Textbox,
+        gr.Column,
+        gr.Button,
+        Optional[dict[str, Any]],
+    ]
+]:
+    message = message.strip()
+
+    if not message:
+        yield get_default_ui_response(chat_history) + (retrieval_state,)
+        return None
+
+    if config_data.AppSettings_QUALITY:
+        type_recommendation, top_items, max_skill_words, dropdown_courses_grades = (
+            config_data.Settings_TYPE_RECOMMENDATION[0],
+            config_data.Settings_TOP_ITEMS_QUALITY,
+            config_data.Settings_MAX_SKILL_WORDS,
+            config_data.DataframeHeaders_COURSES_GRADES[0:1],
+        )
+        dropdown_facets = ()
+
+    facet_cols = (
+        config_data.DataframeHeaders_SUBJECTS_FACETS
+        if type_recommendation == config_data.Settings_TYPE_RECOMMENDATION[0]
+        else config_data.DataframeHeaders_VACANCIES_FACETS
+    )
+
+    filters = {
+        column: values
+        for column, values in zip(
+            config_data.DataframeHeaders_SUBJECTS_FACETS
+            + config_data.DataframeHeaders_VACANCIES_FACETS,
+            dropdown_facets,
+        )
+        if column in facet_cols and values
+    }
+
+    chat_history.append(ChatMessage(role="user", content=message))
+    chat_history.append(ChatMessage(role="assistant", content=""))
+
+    snapshot = data_snapshot()
+
+    if not config_data.AppSettings_DEV and not snapshot.model_manager_sbert.prepare(
+        index_key[0], type_recommendation
+    ):
+        chat_history[-1] = ChatMessage(
+            role="assistant",
+            content=(
+                config_data.InformationMessages_PREPARING_FAILED
+                if snapshot.model_manager_sbert.warm_up_error(
+                    index_key[0], type_recommendation
+                )
+                else config_data.InformationMessages_PREPARING
+            ),
+        )
+
+        yield get_streaming_ui_response(chat_history, send_visible=True)
+        return None
+
+    retrieval_key = (
+        message,
+        type_recommendation,
+        tuple((column, tuple(sorted(values))) for column, values in filters.items()),
+        index_key[0],
+        snapshot.version,
+    )
+    retrieval = get_retrieval_state(retrieval_state, retrieval_key)
+
+    cache_key = retrieval_key + (
+        int(top_items),
+        int(max_skill_words),
+        tuple(sorted(dropdown_courses_grades or [])),
+    )
+
+    content = None if config_data.AppSettings_DEV else response_cache.get(cache_key)
+
+    if content is None:
+        content = ""
+
+        for chunk in generate_response_content(
+            message,
+            type_recommendation,
+            top_items,
+            max_skill_words,
+            dropdown_courses_grades,
+            filters,
+            retrieval,
+            index_key[0],
+            snapshot,
+        ):
+            content += chunk
+            chat_history[-1] = ChatMessage(role="assistant", content=content)
+
+            yield get_streaming_ui_response(chat_history)
+
+        if not config_data.AppSettings_DEV:
+            response_cache.put(cache_key, content)
+
+    chat_history[-1] = ChatMessage(role="assistant", content=content)
+
+    yield (
         gr.Row(visible=not config_data.AppSettings_QUALITY),
         gr.Textbox(value=None, visible=not config_data.AppSettings_QUALITY),
         gr.Button(visible=not config_data.AppSettings_QUALITY),
@@ -484,4 +599,5 @@ def event_handler_generate_response(
             visible=config_data.AppSettings_QUALITY,
             interactive=config_data.AppSettings_QUALITY,
         ),
+        retrieval,
     )
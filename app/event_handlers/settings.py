@@ -10,16 +10,41 @@ from gradio import ChatMessage
 
 # Importing necessary components for the Gradio app
 from app.config import config_data
-from app.data_init import model_manager_sbert
+from app.data_init import data_snapshot
+from app.load_models import SbertModelManager
 
 
-def event_handler_type_recommendation(
-    message: str, type_recommendation: str
-) -> tuple[gr.Number, gr.Dropdown, gr.Row, gr.Dropdown, list[ChatMessage], gr.Button]:
-    model_manager_sbert.change_model(config_data.Models_SBERT[0], type_recommendation)
+def preparing_info(
+    message: str, model_manager_sbert: SbertModelManager, index_key: tuple[str, str]
+) -> str:
+    if model_manager_sbert.prepare(*index_key):
+        return message
+
+    if model_manager_sbert.warm_up_error(*index_key):
+        return f"{message}. {config_data.InformationMessages_PREPARING_FAILED}"
+
+    return f"{message}. {config_data.InformationMessages_PREPARING}"
+
+
+def event_handler_type_recommendation(message: str, type_recommendation: str) -> tuple[
+    gr.Number,
+    gr.Dropdown,
+    gr.Row,
+    gr.Dropdown,
+    list[ChatMessage],
+    gr.Button,
+    tuple[str, str],
+    ...,
+]:
+    index_key = (config_data.Models_SBERT[0], type_recommendation)
+    model_manager_sbert = data_snapshot().model_manager_sbert
 
     gr.Info(
-        message=config_data.AppInfo_TYPE_RECOMMENDATION.format(type_recommendation),
+        message=preparing_info(
+            config_data.AppInfo_TYPE_RECOMMENDATION.format(type_recommendation),
+            model_manager_sbert,
+            index_key,
+        ),
         duration=config_data.AppInfo_DURATION,
         title=config_data.AppInfo_TITLE,
     )
@@ -60,20 +85,42 @@ def event_handler_type_recommendation(
             type="messages",
         ),
         gr.Button(interactive=bool(message.strip())),
+        index_key,
+        # Choices come from the current snapshot, so values added by a reload show up
+        *(
+            gr.Dropdown(
+                choices=model_manager_sbert.get_facet_values(column),
+                value=[],
+                visible=is_subjects,
+            )
+            for column in config_data.DataframeHeaders_SUBJECTS_FACETS
+        ),
+        *(
+            gr.Dropdown(
+                choices=model_manager_sbert.get_facet_values(column),
+                value=[],
+                visible=not is_subjects,
+            )
+            for column in config_data.DataframeHeaders_VACANCIES_FACETS
+        ),
     )
 
 
 def event_handler_dropdown_models(
     message: str, type_recommendation: str, dropdown_models: str
-) -> gr.Button:
-    model_manager_sbert.change_model(dropdown_models, type_recommendation)
+) -> tuple[gr.Button, tuple[str, str]]:
+    index_key = (dropdown_models, type_recommendation)
 
     gr.Info(
-        message=config_data.AppInfo_MODEL.format(dropdown_models),
+        message=preparing_info(
+            config_data.AppInfo_MODEL.format(dropdown_models),
+            data_snapshot().model_manager_sbert,
+            index_key,
+        ),
         duration=config_data.AppInfo_DURATION,
         title=config_data.AppInfo_TITLE,
     )
 
     message = message.strip()
 
-    return gr.Button(interactive=bool(message))
+    return gr.Button(interactive=bool(message)), index_key
@@ -0,0 +1,121 @@
+"""
+File: lexical_index.py
+Author: Dmitry Ryumin and Alexandr Axyonov
+Description: BM25 inverted index over catalog texts.
+License: MIT License
+"""
+
+import math
+import re
+import torch
+from collections import Counter
+from collections.abc import Callable
+from dataclasses import dataclass, field
+
+TOKEN_PATTERN = re.compile(r"[0-9a-zа-я]+(?:[+#]+)?")
+
+RU_ENDINGS = sorted(
+    (
+        "иями ями ами ость ости ение ения ений ого его ому ему ыми ими ой ей ий ый "
+        "ая яя ое ее ые ие ых их ую юю ов ев ам ям ах ях ом ем а я о е ы и у ю ь"
+    ).split(),
+    key=len,
+    reverse=True,
+)
+
+
+def stem(token: str) -> str:
+    if not re.search(r"[а-я]", token):
+        return token
+
+    for ending in RU_ENDINGS:
+        if token.endswith(ending) and len(token) - len(ending) >= 3:
+            return token[: -len(ending)]
+
+    return token
+
+
+def tokenize(text: str) -> list[str]:
+    return [
+        stem(token)
+        for token in TOKEN_PATTERN.findall(text.lower().replace("ё", "е"))
+        if len(token) > 1 or token.isdigit()
+    ]
+
+
+@dataclass
+class LexicalIndex:
+    vocabulary: dict[str, int] = field(default_factory=dict)
+    postings: list[tuple[torch.Tensor, torch.Tensor]] = field(default_factory=list)
+    doc_groups: torch.Tensor = field(
+        default_factory=lambda: torch.empty(0, dtype=torch.long)
+    )
+    size: int = 0
+
+    @classmethod
+    def build(
+        cls,
+        group_names: list[str],
+        group_records: Callable[[str], list[dict]],
+        text_col: str,
+        k1: float = 1.5,
+        b: float = 0.75,
+    ) -> "LexicalIndex":
+        doc_tokens = []
+        doc_groups = []
+
+        for group, name in enumerate(group_names):
+            for record in group_records(name):
+                doc_tokens.append(Counter(tokenize(record.get(text_col) or name)))
+                doc_groups.append(group)
+
+        if not doc_tokens:
+            return cls(size=len(group_names))
+
+        lengths = [sum(tokens.values()) for tokens in doc_tokens]
+        avg_length = max(sum(lengths) / len(lengths), 1)
+
+        token_docs = {}
+
+        for doc, tokens in enumerate(doc_tokens):
+            norm = k1 * (1 - b + b * lengths[doc] / avg_length)
+
+            for token, tf in tokens.items():
+                token_docs.setdefault(token, []).append(
+                    (doc, tf * (k1 + 1) / (tf + norm))
+                )
+
+        vocabulary = {}
+        postings = []
+
+        for token, docs in token_docs.items():
+            idf = math.log(1 + (len(doc_tokens) - len(docs) + 0.5) / (len(docs) + 0.5))
+
+            vocabulary[token] = len(postings)
+            postings.append(
+                (
+                    torch.tensor([doc for doc, _ in docs], dtype=torch.long),
+                    torch.tensor([weight * idf for _, weight in docs]),
+                )
+            )
+
+        return cls(
+            vocabulary,
+            postings,
+            torch.tensor(doc_groups, dtype=torch.long),
+            len(group_names),
+        )
+
+    def group_scores(self, text: str) -> torch.Tensor:
+        doc_scores = torch.zeros(self.doc_groups.numel())
+
+        for token in set(tokenize(text)):
+            if token in self.vocabulary:
+                docs, weights = self.postings[self.vocabulary[token]]
+                doc_scores.index_add_(0, docs, weights)
+
+        scores = torch.zeros(self.size).scatter_reduce_(
+            0, self.doc_groups, doc_scores, reduce="amax", include_self=True
+        )
+
+        return scores / scores.max() if scores.numel() and scores.max() > 0 else scores
@@ -5,6 +5,9 @@ Description: Classes for loading models and updating embeddings.
 License: MIT License
 """
 
+import threading
+import warnings
+from collections import OrderedDict
 import torch
 import polars as pl
 from dataclasses import dataclass, field
@@ -12,31 +15,71 @@ from sentence_transformers import SentenceTransformer
 from typing import Optional
 
 # Importing necessary components for the Gradio app
-from app.gpu_init import device
 from app.config import config_data
-from app.data_utils import load_puds_data, load_vacancies_data, extract_embeddings
+from app.data_utils import (
+    load_puds_data,
+    load_vacancies_data,
+    extract_embeddings,
+    index_records,
+    embedding_records,
+    load_embeddings_index,
+    load_sentence_transformer,
+    model_footprint,
+    release_batch_encoder,
+)
+from app.embeddings_index import EmbeddingIndex, FacetIndex
+from app.lexical_index import LexicalIndex
 
 
-@dataclass
+@dataclass(frozen=True)
 class ModelState:
+    model_name: Optional[str] = None
+    type_recommendation: Optional[str] = None
     current_model: Optional[SentenceTransformer] = None
     embeddings: Optional[torch.Tensor] = field(default_factory=lambda: torch.empty(0))
     names: Optional[pl.DataFrame] = field(default_factory=pl.DataFrame)
+    index: EmbeddingIndex = field(default_factory=EmbeddingIndex)
+    facets: FacetIndex = field(default_factory=FacetIndex)
+    lexical: LexicalIndex = field(default_factory=LexicalIndex)
+    records: list[dict] = field(default_factory=list)
+
+    def search(
+        self,
+        embedding: torch.Tensor,
+        top_k: int,
+        filters: Optional[dict[str, list]] = None,
+        text: Optional[str] = None,
+    ) -> list[tuple[str, float, dict]]:
+        mask = self.facets.row_mask(filters) if filters else None
+        lexical = (
+            self.lexical.group_scores(text)
+            if text and config_data.Models_LEXICAL_WEIGHT > 0
+            else None
+        )
+
+        if mask is not None:
+            mask = mask.to(self.index.row_groups.device)
+
+        return [
+            (name, score, self.records[row])
+            for name, score, row in self.index.search(embedding, top_k, mask, lexical)
+        ]
 
 
 @dataclass
 class BaseModelManager:
     _puds_data: Optional[dict] = field(init=False, default=None)
     _vacancies_data: Optional[dict] = field(init=False, default=None)
-    state: ModelState = field(default_factory=ModelState)
+    _puds_by_name: Optional[dict] = field(init=False, default=None)
+    _vacancies_by_name: Optional[dict] = field(init=False, default=None)
+    _facet_values: dict[str, list] = field(init=False, default_factory=dict)
 
     def __post_init__(self):
-        self._load_puds_data_once()
-        self._load_vacancies_data_once()
+        self._load_puds_data()
+        self._load_vacancies_data()
 
-    @classmethod
-    def _load_puds_data_once(cls):
-        if cls._puds_data is None and not config_data.AppSettings_DEV:
+    def _load_puds_data(self):
+        if self._puds_data is None and not config_data.AppSettings_DEV:
             df_puds_cleaned, _ = load_puds_data(
                 path=config_data.Path_APP / config_data.StaticPaths_PUDS,
                 year=config_data.DataframeHeaders_SUBJECTS_YEAR,
@@ -45,11 +88,13 @@ class BaseModelManager:
                 drop_columns=None,
                 full_info_cols=config_data.DataframeHeaders_SUBJECTS_FULL,
             )
-            cls._puds_data = df_puds_cleaned.to_dicts()
+            self._puds_data = df_puds_cleaned.to_dicts()
+            self._puds_by_name = index_records(
+                self._puds_data, config_data.DataframeHeaders_RU_SUBJECTS[0]
+            )
 
-    @classmethod
-    def _load_vacancies_data_once(cls):
-        if cls._vacancies_data is None and not config_data.AppSettings_DEV:
+    def _load_vacancies_data(self):
+        if self._vacancies_data is None and not config_data.AppSettings_DEV:
             df_vacancies_cleaned, _ = load_vacancies_data(
                 path=config_data.Path_APP / config_data.StaticPaths_VACANCIES,
                 drop_duplicates=False,
@@ -57,7 +102,10 @@ class BaseModelManager:
                 drop_columns=config_data.DataframeHeaders_VACANCIES[0:1],
                 full_info_cols=config_data.DataframeHeaders_VACANCIES[1:],
             )
-            cls._vacancies_data = df_vacancies_cleaned.to_dicts()
+            self._vacancies_data = df_vacancies_cleaned.to_dicts()
+            self._vacancies_by_name = index_records(
+                self._vacancies_data, config_data.DataframeHeaders_VACANCIES[1]
+            )
 
     def get_puds_data(self) -> dict:
         if self._puds_data is None:
@@ -69,47 +117,119 @@ class BaseModelManager:
             return {}
         return self._vacancies_data
 
+    def get_puds_by_name(self, name: str) -> list[dict]:
+        if self._puds_by_name is None:
+            return []
+        return self._puds_by_name.get(name, [])
+
+    def get_vacancies_by_name(self, name: str) -> list[dict]:
+        if self._vacancies_by_name is None:
+            return []
+        return self._vacancies_by_name.get(name, [])
+
+    def get_facet_values(self, column: str) -> list:
+        if column not in self._facet_values:
+            records = (
+                embedding_records(
+                    self.get_vacancies_data(),
+                    config_data.DataframeHeaders_VACANCIES_FULL_INFO,
+                    config_data.DataframeHeaders_VACANCIES[1],
+                )
+                if column in config_data.DataframeHeaders_VACANCIES_FACETS
+                else embedding_records(
+                    self.get_puds_data(),
+                    config_data.DataframeHeaders_SUBJECTS_FULL_INFO,
+                    config_data.DataframeHeaders_RU_SUBJECTS[0],
+                )
+            )
+
+            self._facet_values[column] = sorted(
+                {
+                    record[column]
+                    for record in records
+                    if record.get(column) is not None
+                },
+                key=str,
+            )
+
+        return self._facet_values[column]
+
 
 @dataclass
 class SbertModelManager(BaseModelManager):
-    _loaded_models: dict = field(default_factory=dict, init=False)
-    model_name: Optional[str] = None
+    _loaded_models: OrderedDict[str, tuple[SentenceTransformer, int]] = field(
+        default_factory=OrderedDict, init=False
+    )
+    _registry: dict[tuple[str, str], ModelState] = field(
+        default_factory=dict, init=False
+    )
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False)
+    _build_locks: dict[tuple[str, str], threading.Lock] = field(
+        default_factory=dict, init=False
+    )
+    _warm_up: dict[tuple[str, str], threading.Thread] = field(
+        default_factory=dict, init=False
+    )
+    _failed: dict[tuple[str, str], str] = field(default_factory=dict, init=False)
 
     def load_model(self, model_name: str) -> SentenceTransformer:
-        if model_name in self._loaded_models:
-            self.state.current_model = self._loaded_models[model_name]
-        else:
-            model = SentenceTransformer(
-                model_name_or_path=str(
-                    config_data.Path_APP / config_data.StaticPaths_MODELS / model_name
-                ),
-                device=device,
-                local_files_only=False,
-                trust_remote_code=True,
-            )
-            self.state.current_model = model
-            self._loaded_models[model_name] = model
+        with self._lock:
+            if model_name in self._loaded_models:
+                self._loaded_models.move_to_end(model_name)
+            else:
+                model = load_sentence_transformer(model_name)
 
-        self.model_name = model_name
-        return self.state.current_model
+                self._loaded_models[model_name] = (
+                    model,
+                    model_footprint(model, model_name),
+                )
+                self._evict_models(keep=model_name)
 
-    def get_current_model(self) -> Optional[SentenceTransformer]:
-        if self.state.current_model is None:
-            return None
+            return self._loaded_models[model_name][0]
 
-        return self.state.current_model
+    def _evict_models(self, keep: str) -> None:
+        budget = config_data.Models_POOL_MEMORY_MB * 2**20
 
-    def update_embeddings(self, type_embeddings: str) -> None:
-        if self.state.current_model is None or self.model_name is None:
+        if budget <= 0:
             return None
 
-        data_methods = {
+        while sum(size for _, size in self._loaded_models.values()) > budget:
+            evictable = [
+                model_name
+                for model_name in self._loaded_models
+                if model_name != keep
+                and model_name not in config_data.Models_POOL_PINNED
+            ]
+
+            if not evictable:
+                break
+
+            model_name = evictable[0]
+
+            del self._loaded_models[model_name]
+            self._registry = {
+                key: state
+                for key, state in self._registry.items()
+                if key[0] != model_name
+            }
+            release_batch_encoder(model_name)
+
+    def share_models(self, other: "SbertModelManager") -> None:
+        with other._lock:
+            self._loaded_models = other._loaded_models
+            self._lock = other._lock
+
+    def embedding_sources(self) -> dict[str, tuple]:
+        return {
             config_data.Settings_TYPE_RECOMMENDATION[0]: (
                 self.get_puds_data,
                 config_data.DataframeHeaders_SUBJECTS_FULL_INFO,
                 config_data.DataframeHeaders_RU_SUBJECTS[0],
                 config_data.StaticPaths_PUDS_EMBEDDINGS,
                 config_data.StaticPaths_RU_SUBJECTS,
+                config_data.Models_INDEX_TYPE[0],
+                self.get_puds_by_name,
+                config_data.DataframeHeaders_SUBJECTS_FACETS,
             ),
             config_data.Settings_TYPE_RECOMMENDATION[1]: (
                 self.get_vacancies_data,
@@ -117,36 +237,142 @@ class SbertModelManager(BaseModelManager):
                 config_data.DataframeHeaders_VACANCIES[1],
                 config_data.StaticPaths_VACANCIES_EMBEDDINGS,
                 config_data.StaticPaths_RU_VACANCIES,
+                config_data.Models_INDEX_TYPE[1],
+                self.get_vacancies_by_name,
+                config_data.DataframeHeaders_VACANCIES_FACETS,
             ),
         }
 
-        if type_embeddings in data_methods:
-            get_data, info_col, name_col, embeddings_path, names_path = data_methods[
-                type_embeddings
+    def build_state(self, model_name: str, type_embeddings: str) -> ModelState:
+        if config_data.AppSettings_DEV:
+            return ModelState(model_name, type_embeddings)
+
+        (
+            get_data,
+            info_col,
+            name_col,
+            embeddings_path,
+            names_path,
+            index_type,
+            get_records,
+            facet_cols,
+        ) = self.embedding_sources()[type_embeddings]
+
+        sbert_model = self.load_model(model_name)
+        records = embedding_records(get_data(), info_col, name_col)
+
+        embeddings, names = extract_embeddings(
+            model_name=model_name,
+            d_cleaned=records,
+            sbert_model=sbert_model,
+            info_col=info_col,
+            name_col=name_col,
+            embeddings_path=embeddings_path,
+            names_path=names_path,
+        )
+        index = load_embeddings_index(
+            model_name=model_name,
+            embeddings=embeddings,
+            names=names,
+            index_type=index_type,
+            embeddings_path=embeddings_path,
+        )
+
+        if len(records) != len(index):
+            raise RuntimeError(
+                f"Embeddings cache of {model_name} has {len(index)} rows for "
+                f"{len(records)} records"
+            )
+
+        return ModelState(
+            model_name=model_name,
+            type_recommendation=type_embeddings,
+            current_model=sbert_model,
+            embeddings=embeddings,
+            names=names,
+            index=index,
+            facets=FacetIndex.build(records, facet_cols),
+            lexical=LexicalIndex.build(
+                index.group_names,
+                get_records,
+                info_col,
+                k1=config_data.Models_LEXICAL_K1,
+                b=config_data.Models_LEXICAL_B,
+            ),
+            records=records,
+        )
+
+    def is_ready(self, model_name: str, type_embeddings: str) -> bool:
+        return (model_name, type_embeddings) in self._registry
+
+    def warm_up(self, keys: list[tuple[str, str]]) -> None:
+        with self._lock:
+            pending = [
+                key
+                for key in keys
+                if key not in self._registry
+                and key not in self._failed
+                and not (key in self._warm_up and self._warm_up[key].is_alive())
             ]
-            self.state.embeddings, self.state.names = extract_embeddings(
-                model_name=self.model_name,
-                d_cleaned=get_data(),
-                sbert_model=self.state.current_model,
-                info_col=info_col,
-                name_col=name_col,
-                embeddings_path=embeddings_path,
-                names_path=names_path,
+
+            if not pending:
+                return None
+
+            thread = threading.Thread(
+                target=self._warm_up_states,
+                args=(pending,),
+                name="index-warm-up",
+                daemon=True,
             )
 
-    def get_embeddings(self) -> tuple[torch.Tensor, pl.DataFrame]:
-        if self.state.embeddings.numel() == 0 or self.state.puds_names.is_empty():
-            return (torch.empty(0), pl.DataFrame())
+            for key in pending:
+                self._warm_up[key] = thread
+
+        thread.start()
+
+    def _warm_up_states(self, keys: list[tuple[str, str]]) -> None:
+        for key in keys:
+            try:
+                self.get_state(*key)
+            except Exception as e:
+                with self._lock:
+                    self._failed[key] = str(e)
+
+                warnings.warn(f"Warm-up of {key[0]} / {key[1]} failed: {e}")
+
+    def warm_up_error(self, model_name: str, type_embeddings: str) -> Optional[str]:
+        return self._failed.get((model_name, type_embeddings))
+
+    def prepare(self, model_name: str, type_embeddings: str) -> bool:
+        if self.is_ready(model_name, type_embeddings):
+            return True
+
+        self.warm_up([(model_name, type_embeddings)])
+
+        return False
+
+    def get_state(self, model_name: str, type_embeddings: str) -> ModelState:
+        key = (model_name, type_embeddings)
+        state = self._registry.get(key)
+
+        if state is not None:
+            with self._lock:
+                if model_name in self._loaded_models:
+                    self._loaded_models.move_to_end(model_name)
+
+            return state
+
+        with self._lock:
+            build_lock = self._build_locks.setdefault(key, threading.Lock())
 
-        return (self.state.embeddings, self.state.names)
+        with build_lock:
+            state = self._registry.get(key)
 
-    def get_vacancies_embeddings(self) -> tuple[torch.Tensor, pl.DataFrame]:
-        if self.state.embeddings.numel() == 0:
-            return torch.empty(0)
+            if state is None:
+                state = self.build_state(model_name, type_embeddings)
 
-        return self.state.embeddings
+                with self._lock:
+                    # Readers always see a complete mapping, entries are never mutated
+                    self._registry = {**self._registry, key: state}
 
-    def change_model(self, model_name: str, type_embeddings: str) -> None:
-        if not config_data.AppSettings_DEV:
-            self.load_model(model_name)
-            self.update_embeddings(type_embeddings)
+        return state
@@ -5,14 +5,30 @@ Description: Classes for loading models and updating embeddings.
 License: MIT License
 """
 
+import shutil
+import warnings
 import torch
 from transformers import AutoTokenizer, AutoModel
 from scipy.spatial.distance import cosine
 import pandas as pd
 import numpy as np
+import polars as pl
 
 # Importing necessary components for the Gradio app
 from app.config import config_data
+from app.batch_encoder import BatchEncoder
+from app.cpu_backend import model_backend, quantize_dynamic, select_backend
+from app.data_utils import (
+    content_hash,
+    encode_checkpointed,
+    keys_tensor,
+    mmap_tensors,
+    model_cache_path,
+    model_revision,
+    save_parquet,
+    save_tensors,
+    tensor_keys,
+)
 
 
 def load_embeddings(path):
@@ -21,14 +37,91 @@ def load_embeddings(path):
     return df
 
 
+def vacancy_cache_paths(model_name=config_data.Models_SBERT_VACANCY[0]):
+    embeddings_path = model_cache_path(
+        config_data.StaticPaths_VACANCY_EMBEDDINGS, model_name
+    )
+
+    return embeddings_path, embeddings_path.with_suffix(".parquet")
+
+
+def vacancy_texts(initial_df):
+    texts = dict.fromkeys(initial_df.parent.values)
+
+    for key_skills in initial_df.key_skills.values:
+        texts.update(dict.fromkeys(key_skills))
+
+    known = set(initial_df.with_name.values)
+
+    return [text for text in texts if isinstance(text, str) and text not in known]
+
+
+def load_vacancy_model(
+    model_path, tokenizer, model_name=config_data.Models_SBERT_VACANCY[0]
+):
+    model = AutoModel.from_pretrained(model_path)
+    backend = model_backend(model_name)
+
+    if backend == "torch":
+        return model
+
+    if backend == "onnx":
+        warnings.warn(
+            f"{model_name}: the onnx backend is not available for pooled vacancy "
+            "embeddings, using quantized"
+        )
+
+    def encode(vacancy_model, texts):
+        encoded_input = tokenizer(
+            texts, padding=True, truncation=True, max_length=64, return_tensors="pt"
+        )
+
+        return vacancy_model(**encoded_input).pooler_output
+
+    return select_backend(model_name, model, lambda: quantize_dynamic(model), encode)
+
+
+def normalize_rows(embeddings):
+    matrix = np.ascontiguousarray(np.stack(embeddings), dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+
+    return matrix / np.maximum(norms, 1e-12)
+
+
+def top_k(scores, amount):
+    amount = min(amount, scores.shape[0])
+
+    if amount <= 0:
+        return np.empty(0, dtype=np.int64)
+
+    rows = np.argpartition(-scores, amount - 1)[:amount]
+
+    return rows[np.argsort(-scores[rows], kind="stable")]
+
+
 class EmbeddingExtractor:
-    def __init__(self, model, tokenizer, initial_df, similarity_metric=cosine):
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        initial_df,
+        similarity_metric=cosine,
+        model_name=config_data.Models_SBERT_VACANCY[0],
+    ):
         self.embeddings = {}
         self.model = model
         self.tokenizer = tokenizer
         self.similarity_metric = similarity_metric
+        self.batch_encoder = BatchEncoder(
+            encode_fn=self.extract_batch,
+            max_batch=config_data.Models_BATCHING_MAX_BATCH,
+            max_wait=config_data.Models_BATCHING_MAX_WAIT_MS / 1000,
+        )
+
+        self.model_name = model_name
 
         self._initialize_embeddings(initial_df)
+        self._load_cached_embeddings()
 
     def _initialize_embeddings(self, initial_df):
         for _, row in initial_df.iterrows():
@@ -37,20 +130,129 @@ class EmbeddingExtractor:
 
             self.embeddings[name] = emb
 
+    def _load_cached_embeddings(self):
+        embeddings_path, texts_path = vacancy_cache_paths(self.model_name)
+
+        if not embeddings_path.is_file() or not texts_path.is_file():
+            return None
+
+        tensors, metadata = mmap_tensors(embeddings_path)
+
+        if metadata.get("revision") != model_revision(self.model_name):
+            return None
+
+        embeddings = tensors["embeddings"].numpy()
+        texts = pl.read_parquet(texts_path)["texts"].to_list()
+
+        # Texts are written after the vectors, so a stale file shows up as a key mismatch
+        if "keys" not in tensors or tensor_keys(tensors["keys"]) != [
+            content_hash(text) for text in texts
+        ]:
+            return None
+
+        for row, text in enumerate(texts):
+            self.embeddings.setdefault(text, embeddings[row])
+
+    def extract_corpus(self, texts, progress=None):
+        batch_size = config_data.Models_ENCODING_BATCH_SIZE
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]), reverse=True)
+
+        embeddings = None
+
+        for start in range(0, len(order), batch_size):
+            batch = order[start : start + batch_size]
+            batch_embeddings = torch.from_numpy(
+                self.extract_batch([texts[i] for i in batch])
+            )
+
+            if embeddings is None:
+                embeddings = batch_embeddings.new_empty(
+                    (len(texts), batch_embeddings.size(1))
+                )
+
+            embeddings[torch.tensor(batch)] = batch_embeddings
+
+            if progress is not None:
+                progress(min(start + batch_size, len(texts)), len(texts))
+
+        return embeddings if embeddings is not None else torch.empty(0)
+
+    def build_cache(self, initial_df, progress=None):
+        embeddings_path, texts_path = vacancy_cache_paths(self.model_name)
+        checkpoint_path = embeddings_path.with_name(
+            f"{embeddings_path.stem}_checkpoint"
+        )
+        metadata = {
+            "model": self.model_name,
+            "revision": model_revision(self.model_name),
+        }
+
+        texts = vacancy_texts(initial_df)
+        missing = [text for text in texts if text not in self.embeddings]
+
+        encoded = encode_checkpointed(
+            missing,
+            [content_hash(text) for text in missing],
+            self.extract_corpus,
+            checkpoint_path,
+            metadata,
+            progress,
+        )
+
+        for row, text in enumerate(missing):
+            self.embeddings[text] = encoded[row].numpy()
+
+        if texts:
+            save_tensors(
+                {
+                    "embeddings": torch.from_numpy(
+                        np.stack([self.embeddings[text] for text in texts]).astype(
+                            np.float32
+                        )
+                    ),
+                    "keys": keys_tensor([content_hash(text) for text in texts]),
+                },
+                embeddings_path,
+                metadata,
+            )
+            save_parquet(pl.DataFrame({"texts": texts}), texts_path)
+
+        shutil.rmtree(checkpoint_path, ignore_errors=True)
+
+        return len(missing)
+
     def extract(self, text):
         if text in self.embeddings:
             return self.embeddings[text]
 
+        embedding = self.batch_encoder.encode(text).copy()
+
+        self.embeddings[text] = embedding
+
+        return embedding
+
+    def extract_many(self, texts):
+        # Serial callers encode all misses at once instead of waiting on the batcher
+        missing = list(
+            dict.fromkeys(text for text in texts if text not in self.embeddings)
+        )
+
+        if missing:
+            embeddings = self.extract_corpus(missing).numpy()
+
+            for row, text in enumerate(missing):
+                self.embeddings[text] = embeddings[row]
+
+        return [self.embeddings[text] for text in texts]
+
+    def extract_batch(self, texts):
         encoded_input = self.tokenizer(
-            [text], padding=True, truncation=True, max_length=64, return_tensors="pt"
+            texts, padding=True, truncation=True, max_length=64, return_tensors="pt"
         )
         with torch.no_grad():
             model_output = self.model(**encoded_input)
-        embedding = model_output.pooler_output[0].numpy().astype(np.float32)
 
-        self.embeddings[text] = embedding
-
-        return embedding
+        return model_output.pooler_output.numpy().astype(np.float32)
 
     def similarity(self, emb1, emb2):
         return 1 - self.similarity_metric(emb1, emb2)
@@ -59,69 +261,74 @@ class EmbeddingExtractor:
 class VacancyFinder:
     def __init__(self, embedding_extractor, initial_df):
         self.embedding_extractor = embedding_extractor
-        self.titles = {}
-        self.vacancy_stats_by_title = {}
+        self.title_names = []
+        self.title_embeddings = np.empty((0, 0), dtype=np.float32)
+        self.vacancies = []
+        self.vacancy_ids = np.empty(0)
+        self.vacancy_embeddings = np.empty((0, 0), dtype=np.float32)
+        self.title_offsets = np.zeros(1, dtype=np.int64)
 
         self._load_vacancies(initial_df)
 
     def _load_vacancies(self, initial_df):
-        titles = list(set(initial_df.parent.values))
+        if initial_df.empty:
+            return None
 
-        for title in titles:
-            self.titles[title] = self.embedding_extractor.extract(title)
-            self.vacancy_stats_by_title[title] = []
+        # Vacancies of one title are stored as a contiguous block of rows
+        vacancies_df = initial_df.sort_values("parent", kind="stable")
+        titles, counts = np.unique(vacancies_df.parent.values, return_counts=True)
 
-            for _, row in initial_df[initial_df.parent == title].iterrows():
-                name = row["with_name"]
-                key_skills = row["key_skills"]
-                id_ = row["id"]
+        self.title_names = titles.tolist()
+        self.title_embeddings = normalize_rows(
+            self.embedding_extractor.extract_many(self.title_names)
+        )
 
-                self.vacancy_stats_by_title[title].append(
-                    [name, key_skills, id_, self.embedding_extractor.extract(name)]
-                )
+        self.vacancies = [
+            [name, key_skills, id_, embedding, title]
+            for name, key_skills, id_, title, embedding in zip(
+                vacancies_df.with_name.values,
+                vacancies_df.key_skills.values,
+                vacancies_df.id.values,
+                vacancies_df.parent.values,
+                self.embedding_extractor.extract_many(
+                    vacancies_df.with_name.values.tolist()
+                ),
+            )
+        ]
+        self.vacancy_ids = vacancies_df.id.values
+        self.vacancy_embeddings = normalize_rows(
+            [vacancy[3] for vacancy in self.vacancies]
+        )
+        self.title_offsets = np.concatenate(([0], np.cumsum(counts)))
 
     def _select_best_titles(self, emb, amount):
-        stats = []
-        for title_name, title_emb in self.titles.items():
-            stats.append(
-                [
-                    title_name,
-                    title_emb,
-                    self.embedding_extractor.similarity(emb, title_emb),
-                ]
-            )
+        return top_k(self.title_embeddings @ emb, amount)
 
-        return sorted(stats, key=lambda x: -x[-1])[:amount]
-
-    def _select_best_vacancies(self, emb, titles, amount):
-        stats = []
-        for title in titles:
-            for (
-                vacancy_name,
-                key_skills,
-                vacancy_id,
-                vacancy_emb,
-            ) in self.vacancy_stats_by_title[title]:
-                stats.append(
-                    [
-                        vacancy_name,
-                        key_skills,
-                        vacancy_id,
-                        vacancy_emb,
-                        title,
-                        self.embedding_extractor.similarity(emb, vacancy_emb),
-                    ]
-                )
+    def _select_best_vacancies(self, emb, title_rows, amount):
+        if len(title_rows) == 0:
+            return []
 
-        return sorted(stats, key=lambda x: -x[-1])[:amount]
+        rows = np.concatenate(
+            [
+                np.arange(self.title_offsets[row], self.title_offsets[row + 1])
+                for row in title_rows
+            ]
+        )
+        scores = self.vacancy_embeddings[rows] @ emb
+
+        return [
+            self.vacancies[rows[row]] + [float(scores[row])]
+            for row in top_k(scores, amount)
+        ]
 
     def get_best_vacancies(self, vacancy_name, nearest_titles=3, amount=20):
-        emb = self.embedding_extractor.extract(vacancy_name)
-        titles = self._select_best_titles(emb, nearest_titles)
-        title_names = [title_name for title_name, _, _ in titles]
+        if not self.title_names:
+            return []
+
+        emb = normalize_rows([self.embedding_extractor.extract(vacancy_name)])[0]
+        title_rows = self._select_best_titles(emb, nearest_titles)
 
-        best_vacancies = self._select_best_vacancies(emb, title_names, amount)
-        return best_vacancies
+        return self._select_best_vacancies(emb, title_rows, amount)
 
 
 class SkillsExtractor:
@@ -138,15 +345,29 @@ class SkillsExtractor:
             / config_data.StaticPaths_MODELS
             / config_data.Models_SBERT_VACANCY[0]
         ),
+        model=None,
+        tokenizer=None,
     ):
+        self.model = model
+        self.tokenizer = tokenizer
+
         if not config_data.AppSettings_DEV:
-            tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
-            model = AutoModel.from_pretrained(model_path)
+            if self.tokenizer is None:
+                self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
+            if self.model is None:
+                self.model = load_vacancy_model(model_path, self.tokenizer)
+
             emb_df = load_embeddings(path_to_vacancies_info)
 
-            self.embedding_extractor = EmbeddingExtractor(model, tokenizer, emb_df)
+            self.embedding_extractor = EmbeddingExtractor(
+                self.model, self.tokenizer, emb_df
+            )
             self.vacancy_finder = VacancyFinder(self.embedding_extractor, emb_df)
 
+    def close(self):
+        if not config_data.AppSettings_DEV:
+            self.embedding_extractor.batch_encoder.close()
+
     def key_skills_for_profession(
         self,
         profession,
@@ -165,29 +386,28 @@ class SkillsExtractor:
         selected_skills = []
         counted_skills = {}
 
-        for skill in all_key_skills:
-            found = False
-            for selected_skill in selected_skills:
+        if filter_near and all_key_skills:
+            skill_embs = normalize_rows(
+                self.embedding_extractor.extract_many(all_key_skills)
+            )
+            selected_embs = np.empty_like(skill_embs)
+
+        for row, skill in enumerate(all_key_skills):
+            if filter_near:
+                # The first selected skill closer than the threshold absorbs the skill
+                near = np.flatnonzero(
+                    selected_embs[: len(selected_skills)] @ skill_embs[row] > 0.9
+                )
+                selected_skill = selected_skills[near[0]] if near.size else None
+            else:
+                selected_skill = skill if skill in counted_skills else None
+
+            if selected_skill is not None:
+                counted_skills[selected_skill] += 1
+            else:
                 if filter_near:
-                    selected_skill_emb = self.embedding_extractor.extract(
-                        selected_skill
-                    )
-                    skill_emb = self.embedding_extractor.extract(skill)
-                    similarity = self.embedding_extractor.similarity(
-                        skill_emb, selected_skill_emb
-                    )
-                else:
-                    if skill == selected_skill:
-                        similarity = 1.0
-                    else:
-                        similarity = 0.0
-
-                if similarity > 0.9:
-                    found = True
-                    counted_skills[selected_skill] += 1
-                    break
-
-            if not found:
+                    selected_embs[len(selected_skills)] = skill_embs[row]
+
                 selected_skills.append(skill)
                 counted_skills[skill] = 1
 
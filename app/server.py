@@ -5,6 +5,8 @@ Description: Server for the application.
 License: MIT License
 """
 
+import hmac
+import threading
 import uvicorn
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
@@ -12,6 +14,7 @@ from fastapi.middleware.cors import CORSMiddleware
 # Importing necessary components for the Gradio app
 from app.config import config_data
 from app.db import save_data
+from app.data_init import reload_data
 
 app = FastAPI()
 
@@ -50,6 +53,27 @@ async def receive_data(request: Request):
         }
 
 
+@app.post("/api/reload")
+async def reload(request: Request):
+    # Served only in QUALITY mode, when app.py starts this server
+    if not config_data.Reload_TOKEN or not hmac.compare_digest(
+        request.headers.get("X-Reload-Token", ""), config_data.Reload_TOKEN
+    ):
+        return {
+            "message": "Доступ запрещен",
+            "status": "error",
+        }
+
+    threading.Thread(
+        target=reload_data, kwargs={"force": True}, name="data-reload", daemon=True
+    ).start()
+
+    return {
+        "message": "Обновление данных запущено",
+        "status": "success",
+    }
+
+
 server = None
 
 
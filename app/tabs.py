@@ -15,6 +15,7 @@ from app.html_components import ADD_RANGE
 from app.config import config_data
 from app.requirements_app import read_requirements
 from app.components import html_message
+from app.data_init import data_snapshot
 
 
 def app_tab():
@@ -227,6 +228,8 @@ def app_tab():
             elem_classes="chatbot-timer",
         )
 
+        retrieval_state = gr.State(value=None)
+
         with gr.Row(
             visible=False,
             render=True,
@@ -373,10 +376,15 @@ def app_tab():
         feedback,
         evaluate_column,
         send_evaluate,
+        retrieval_state,
     )
 
 
 def settings_app_tab():
+    index_key = gr.State(
+        value=(config_data.Models_SBERT[0], config_data.Settings_TYPE_RECOMMENDATION[0])
+    )
+
     with gr.Column(
         visible=True,
         render=True,
@@ -476,6 +484,35 @@ def settings_app_tab():
                 render=True,
                 elem_classes="dropdown-courses-grades",
             )
+        with gr.Row(
+            visible=True,
+            render=True,
+            variant="default",
+            elem_classes="row-3-container",
+        ):
+            dropdown_facets = [
+                gr.Dropdown(
+                    choices=data_snapshot().model_manager_sbert.get_facet_values(
+                        column
+                    ),
+                    value=[],
+                    multiselect=True,
+                    allow_custom_value=False,
+                    label=label,
+                    info=config_data.InformationMessages_FACETS,
+                    show_label=True,
+                    interactive=True,
+                    visible=column in config_data.DataframeHeaders_SUBJECTS_FACETS,
+                    render=True,
+                    elem_classes="dropdown-facets",
+                )
+                for column, label in zip(
+                    config_data.DataframeHeaders_SUBJECTS_FACETS
+                    + config_data.DataframeHeaders_VACANCIES_FACETS,
+                    config_data.Labels_FACETS_SUBJECTS
+                    + config_data.Labels_FACETS_VACANCIES,
+                )
+            ]
 
     return (
         type_recommendation,
@@ -484,6 +521,8 @@ def settings_app_tab():
         dropdown_models,
         settings_row_2,
         dropdown_courses_grades,
+        dropdown_facets,
+        index_key,
     )
 
 
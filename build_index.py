@@ -0,0 +1,141 @@
+"""
+File: build_index.py
+Author: Dmitry Ryumin and Alexandr Axyonov
+Description: Offline build of the embeddings caches and retrieval indexes.
+             Builds every SBERT model for both recommendation types and the
+             vacancy skills cache, resuming from checkpoints of interrupted runs.
+License: MIT License
+"""
+
+import argparse
+import sys
+import time
+
+from transformers import AutoTokenizer
+
+# Importing necessary components for the Gradio app
+from app.config import config_data
+from app.data_utils import extract_embeddings, load_embeddings_index
+from app.load_models import SbertModelManager
+from app.load_vacancy_models import (
+    EmbeddingExtractor,
+    load_embeddings,
+    load_vacancy_model,
+)
+
+
+def progress_printer(label: str, encoded: list[int]):
+    def progress(done: int, total: int) -> None:
+        encoded[0] = done
+        print(f"\r{label}: {done}/{total}", end="", file=sys.stderr, flush=True)
+
+    return progress
+
+
+def report(label: str, rows: int, encoded: int, seconds: float) -> None:
+    print(
+        f"\r{label}: {rows} rows, {encoded} encoded in {seconds:.1f} s "
+        f"({encoded / max(seconds, 1e-9):.1f} rows/s)"
+    )
+
+
+def build_sbert(
+    model_manager: SbertModelManager,
+    model_name: str,
+    type_recommendation: str,
+    force_reload: bool = False,
+) -> None:
+    label = f"{model_name} / {type_recommendation}"
+    encoded = [0]
+
+    (
+        get_data,
+        info_col,
+        name_col,
+        embeddings_path,
+        names_path,
+        index_type,
+        _,
+        _,
+    ) = model_manager.embedding_sources()[type_recommendation]
+
+    start = time.perf_counter()
+
+    embeddings, names = extract_embeddings(
+        model_name=model_name,
+        d_cleaned=get_data(),
+        sbert_model=model_manager.load_model(model_name),
+        info_col=info_col,
+        name_col=name_col,
+        embeddings_path=embeddings_path,
+        names_path=names_path,
+        force_reload=force_reload,
+        progress=progress_printer(label, encoded),
+        policy="incremental",
+        workers=config_data.Models_ENCODING_WORKERS,
+    )
+    load_embeddings_index(
+        model_name=model_name,
+        embeddings=embeddings,
+        names=names,
+        index_type=index_type,
+        embeddings_path=embeddings_path,
+    )
+
+    report(label, embeddings.size(0), encoded[0], time.perf_counter() - start)
+
+
+def build_vacancy(model_name: str) -> None:
+    model_path = str(config_data.Path_APP / config_data.StaticPaths_MODELS / model_name)
+    initial_df = load_embeddings(config_data.Path_APP / config_data.StaticPaths_VACANCY)
+
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+
+    embedding_extractor = EmbeddingExtractor(
+        load_vacancy_model(model_path, tokenizer, model_name),
+        tokenizer,
+        initial_df,
+        model_name=model_name,
+    )
+
+    encoded = [0]
+    start = time.perf_counter()
+
+    embedding_extractor.build_cache(
+        initial_df, progress=progress_printer(model_name, encoded)
+    )
+
+    report(
+        model_name,
+        len(embedding_extractor.embeddings),
+        encoded[0],
+        time.perf_counter() - start,
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Build the embeddings caches and retrieval indexes offline"
+    )
+    parser.add_argument("--models", nargs="+", default=config_data.Models_SBERT)
+    parser.add_argument(
+        "--types", nargs="+", default=config_data.Settings_TYPE_RECOMMENDATION
+    )
+    parser.add_argument(
+        "--rebuild", action="store_true", help="re-encode every row of every cache"
+    )
+    parser.add_argument("--skip-vacancy", action="store_true")
+    args = parser.parse_args()
+
+    model_manager = SbertModelManager()
+
+    for model_name in args.models:
+        for type_recommendation in args.types:
+            build_sbert(model_manager, model_name, type_recommendation, args.rebuild)
+
+    if not args.skip_vacancy:
+        build_vacancy(config_data.Models_SBERT_VACANCY[0])
+
+
+if __name__ == "__main__":
+    main()